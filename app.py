@@ -2,8 +2,20 @@ import jwt
 import time
 import datetime
 import os
-from flask import Flask, request, jsonify, make_response, send_from_directory
+import json
+import itertools
+import math
+import threading
+import sqlite3
+import tempfile
+import ipaddress
+from urllib.parse import urlsplit
+from flask import Flask, request, jsonify, make_response, send_from_directory, Response, stream_with_context, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, DDL, func, text, exists, and_, or_, table, column, literal_column, literal, case, select
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.exc import OperationalError, IntegrityError
 import boto3  # Adicionado para S3
 
 # --- 1. CONFIGURAÇÃO INICIAL (ATUALIZADA PARA DEPLOY) ---
@@ -25,6 +37,16 @@ else:
     basedir = os.path.abspath(os.path.dirname(__file__))
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'api.db')
 
+# (Opcional) Réplica somente-leitura usada pelas leituras dos endpoints de resultado
+DATABASE_URL_READONLY = os.environ.get('DATABASE_URL_READONLY')
+
+if DATABASE_URL_READONLY:
+    if DATABASE_URL_READONLY.startswith("postgres://"):
+        DATABASE_URL_READONLY = DATABASE_URL_READONLY.replace("postgres://", "postgresql://", 1)
+    app.config['SQLALCHEMY_BINDS'] = {
+        'leitura': {'url': DATABASE_URL_READONLY, 'pool_pre_ping': True}
+    }
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
@@ -36,6 +58,9 @@ class Cliente(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nome_relacional = db.Column(db.String(80), unique=True, nullable=False)
     token_api = db.Column(db.String(120), nullable=False)
+    # Limites de uso por cliente (None = usa os valores padrão de LIMITE_PADRAO_*)
+    limite_requisicoes_minuto = db.Column(db.Integer, nullable=True)
+    limite_concorrencia = db.Column(db.Integer, nullable=True)
     pesquisas = db.relationship('Pesquisa', backref='cliente', lazy=True)
 
 
@@ -52,15 +77,31 @@ class Pesquisa(db.Model):
     # TÓPICO 2: Adiciona coluna para limpeza de custos
     data_entrega = db.Column(db.DateTime, nullable=True)
 
-    processos = db.relationship('Processo', backref='pesquisa', lazy=True)
+    # URL (opcional) chamada pelo importar_resultados.py quando a pesquisa fica CONCLUIDO
+    url_callback = db.Column(db.String(500), nullable=True)
+
+    # Os processos são compartilhados entre pesquisas (e clientes) pela tabela de ligação pesquisa_processo
+    processos = db.relationship('Processo', secondary='pesquisa_processo', backref='pesquisas', lazy=True)
+
+
+# Ligação N:N entre pesquisas e o cadastro único de processos
+pesquisa_processo = db.Table(
+    'pesquisa_processo',
+    db.Column('pesquisa_id', db.Integer, db.ForeignKey('pesquisa.id'), primary_key=True),
+    db.Column('processo_id', db.Integer, db.ForeignKey('processo.id'), primary_key=True, index=True)
+)
 
 
 class Processo(db.Model):
+    # Um único registro por número CNJ: capa, partes, andamentos e documentos são raspados e
+    # guardados uma vez e entregues a todas as pesquisas que pediram o número.
     __tablename__ = 'processo'
     id = db.Column(db.Integer, primary_key=True)
-    pesquisa_id = db.Column(db.Integer, db.ForeignKey('pesquisa.id'), nullable=False)
-    numero_processo = db.Column(db.String(100), nullable=False)
+    numero_processo = db.Column(db.String(100), nullable=False, unique=True)
     dados_processo_encontrado = db.Column(db.Boolean, default=False)
+    # Lote (arquivo pendentes_*.xlsx) em que o número foi enviado ao robô e cujo resultado ainda não foi
+    # importado. None = nunca exportado ou já respondido (com dados ou "não encontrado").
+    lote_exportacao = db.Column(db.String(40), nullable=True, index=True)
     capa = db.relationship('CapaProcesso', backref='processo', uselist=False, lazy=True)
     documentos = db.relationship('DocumentoInicial', backref='processo', lazy=True)
     andamentos = db.relationship('Andamento', backref='processo', lazy=True)
@@ -68,14 +109,36 @@ class Processo(db.Model):
     advogados = db.relationship('Advogado', backref='processo', lazy=True)
 
 
+# --- Tabelas de valores repetidos (cada texto é guardado uma única vez e referenciado por id) ---
+
+class Rotulo(db.Model):
+    # Textos curtos e muito repetidos: Parte.tipo, Advogado.tipo, CapaProcesso.classe_cnj e area
+    __tablename__ = 'rotulo'
+    id = db.Column(db.Integer, primary_key=True)
+    valor = db.Column(db.String(200), unique=True, nullable=False)
+
+
+class DescricaoAndamento(db.Model):
+    # Texto dos andamentos. A unicidade fica no hash (SHA-1) porque o texto pode ser grande demais para um índice
+    __tablename__ = 'descricao_andamento'
+    id = db.Column(db.Integer, primary_key=True)
+    hash_texto = db.Column(db.String(40), unique=True, nullable=False)
+    texto = db.Column(db.Text, nullable=False)
+
+
 class CapaProcesso(db.Model):
     # CORRIGIDO: Mapeia para o nome exato do erro ('capaprocessp')
     __tablename__ = 'capaprocessp'
     id = db.Column(db.Integer, primary_key=True)
     processo_id = db.Column(db.Integer, db.ForeignKey('processo.id'), unique=True, nullable=False)
     valor_causa = db.Column(db.Float, nullable=True)
-    classe_cnj = db.Column(db.String(200), default="")
-    area = db.Column(db.String(100), default="")
+    classe_cnj_id = db.Column(db.Integer, db.ForeignKey('rotulo.id'), nullable=True)
+    area_id = db.Column(db.Integer, db.ForeignKey('rotulo.id'), nullable=True)
+    classe_cnj_ref = db.relationship('Rotulo', foreign_keys=[classe_cnj_id], lazy='joined')
+    area_ref = db.relationship('Rotulo', foreign_keys=[area_id], lazy='joined')
+    # Somente leitura (a gravação é feita pelo id, ver importar_resultados.py)
+    classe_cnj = association_proxy('classe_cnj_ref', 'valor')
+    area = association_proxy('area_ref', 'valor')
 
 
 class DocumentoInicial(db.Model):
@@ -91,16 +154,59 @@ class DocumentoInicial(db.Model):
 class Andamento(db.Model):
     __tablename__ = 'andamento'
     id = db.Column(db.Integer, primary_key=True)
-    processo_id = db.Column(db.Integer, db.ForeignKey('processo.id'), nullable=False)
+    processo_id = db.Column(db.Integer, db.ForeignKey('processo.id'), nullable=False, index=True)
     data = db.Column(db.DateTime, default=datetime.datetime.utcnow)
-    descricao = db.Column(db.Text)
+    descricao_id = db.Column(db.Integer, db.ForeignKey('descricao_andamento.id'), nullable=True, index=True)
+    descricao_ref = db.relationship('DescricaoAndamento', lazy='joined')
+    descricao = association_proxy('descricao_ref', 'texto')  # Somente leitura
+
+
+# Índice de texto completo das descrições de andamento (usado pelo buscaTextoAndamentos).
+# Fica na tabela de descrições, onde cada texto aparece uma única vez.
+# PostgreSQL: índice GIN sobre o tsvector. SQLite (local): tabela FTS5 mantida por triggers.
+# Os dois bancos ignoram acentos ("sentenca" encontra "Sentença"): no SQLite pelo remove_diacritics do
+# FTS5 e no PostgreSQL pela configuração de busca CONFIGURACAO_BUSCA_TEXTO (português + extensão unaccent).
+CONFIGURACAO_BUSCA_TEXTO = 'portugues_sem_acento'
+DDL_BUSCA_TEXTO_POSTGRESQL = [
+    DDL("CREATE EXTENSION IF NOT EXISTS unaccent"),
+    DDL("DO $$ BEGIN "
+        f"IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = '{CONFIGURACAO_BUSCA_TEXTO}') THEN "
+        f"CREATE TEXT SEARCH CONFIGURATION {CONFIGURACAO_BUSCA_TEXTO} (COPY = portuguese); "
+        f"ALTER TEXT SEARCH CONFIGURATION {CONFIGURACAO_BUSCA_TEXTO} "
+        "ALTER MAPPING FOR hword, hword_part, word WITH unaccent, portuguese_stem; "
+        "END IF; END $$"),
+    DDL("CREATE INDEX IF NOT EXISTS ix_descricao_andamento_fts ON descricao_andamento "
+        f"USING gin (to_tsvector('{CONFIGURACAO_BUSCA_TEXTO}', texto))"),
+]
+for _ddl in [
+    *(ddl.execute_if(dialect='postgresql') for ddl in DDL_BUSCA_TEXTO_POSTGRESQL),
+    DDL("CREATE VIRTUAL TABLE IF NOT EXISTS descricao_andamento_fts USING fts5("
+        "texto, content='descricao_andamento', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        ).execute_if(dialect='sqlite'),
+    DDL("CREATE TRIGGER IF NOT EXISTS descricao_andamento_fts_ai AFTER INSERT ON descricao_andamento BEGIN "
+        "INSERT INTO descricao_andamento_fts(rowid, texto) VALUES (new.id, new.texto); END"
+        ).execute_if(dialect='sqlite'),
+    DDL("CREATE TRIGGER IF NOT EXISTS descricao_andamento_fts_ad AFTER DELETE ON descricao_andamento BEGIN "
+        "INSERT INTO descricao_andamento_fts(descricao_andamento_fts, rowid, texto) "
+        "VALUES ('delete', old.id, old.texto); END").execute_if(dialect='sqlite'),
+    DDL("CREATE TRIGGER IF NOT EXISTS descricao_andamento_fts_au AFTER UPDATE ON descricao_andamento BEGIN "
+        "INSERT INTO descricao_andamento_fts(descricao_andamento_fts, rowid, texto) "
+        "VALUES ('delete', old.id, old.texto); "
+        "INSERT INTO descricao_andamento_fts(rowid, texto) VALUES (new.id, new.texto); END"
+        ).execute_if(dialect='sqlite'),
+]:
+    event.listen(DescricaoAndamento.__table__, 'after_create', _ddl)
+event.listen(DescricaoAndamento.__table__, 'before_drop',
+             DDL("DROP TABLE IF EXISTS descricao_andamento_fts").execute_if(dialect='sqlite'))
 
 
 class Parte(db.Model):
     __tablename__ = 'parte'
     id = db.Column(db.Integer, primary_key=True)
     processo_id = db.Column(db.Integer, db.ForeignKey('processo.id'), nullable=False)
-    tipo = db.Column(db.String(100))
+    tipo_id = db.Column(db.Integer, db.ForeignKey('rotulo.id'), nullable=True)
+    tipo_ref = db.relationship('Rotulo', lazy='joined')
+    tipo = association_proxy('tipo_ref', 'valor')  # Somente leitura
     nome = db.Column(db.String(500))
 
 
@@ -108,22 +214,327 @@ class Advogado(db.Model):
     __tablename__ = 'advogado'
     id = db.Column(db.Integer, primary_key=True)
     processo_id = db.Column(db.Integer, db.ForeignKey('processo.id'), nullable=False)
-    tipo = db.Column(db.String(100))
+    tipo_id = db.Column(db.Integer, db.ForeignKey('rotulo.id'), nullable=True)
+    tipo_ref = db.relationship('Rotulo', lazy='joined')
+    tipo = association_proxy('tipo_ref', 'valor')  # Somente leitura
     nome = db.Column(db.String(500))
     oab = db.Column(db.String(50), nullable=True)
 
 
-# --- 3. HELPER (Função para validar o token) ---
-def validar_token():
+# --- 3. HELPERS (Validação do token e limites de uso por cliente) ---
+
+# Limites padrão (podem ser trocados por cliente nas colunas limite_* da tabela cliente).
+# O estado (tokens e requisições em andamento) fica em um arquivo SQLite local, compartilhado por todos os
+# workers do gunicorn da máquina: na memória de cada worker (sync, uma requisição por vez) o limite de
+# simultâneas nunca seria atingido. Com várias instâncias/máquinas, cada uma tem o seu arquivo.
+ARQUIVO_LIMITES = os.environ.get('ARQUIVO_LIMITES') or os.path.join(tempfile.gettempdir(),
+                                                                    'andamentosconsult_limites.db')
+TEMPO_MAXIMO_REQUISICAO = 300  # Segundos: a vaga de uma requisição não liberada (ex.: worker morto) expira
+LIMITE_PADRAO_REQUISICOES_MINUTO = 120
+LIMITE_PADRAO_CONCORRENCIA = 4  # Requisições "pesadas" simultâneas por cliente
+LIMITE_ESPERAS_SIMULTANEAS = 2  # Long-polls (statusPesquisa) simultâneos por cliente, separados das pesadas
+# Long-polls simultâneos somando todos os clientes: cada espera prende uma thread do gunicorn, então este
+# valor deve ficar abaixo do total de threads da máquina (workers x --threads) para sobrar vaga às demais rotas
+LIMITE_ESPERAS_TOTAL = int(os.environ.get('LIMITE_ESPERAS_TOTAL', 4))
+PROCESSOS_POR_TOKEN = 100  # CadastraPesquisa consome 1 token extra a cada 100 processos
+TEMPO_CACHE_LIMITES = 60  # Segundos que os limites lidos do banco ficam em cache
+
+_cache_limites = {}  # id_cliente -> (expira_em, requisicoes_minuto, concorrencia)
+_conexao_limites = threading.local()  # Uma conexão com o ARQUIVO_LIMITES por thread
+
+
+def conexao_limites():
+    """ Conexão com o SQLite de limites (tabelas balde e requisicao_ativa), criada na primeira chamada da thread. """
+    conexao = getattr(_conexao_limites, 'conexao', None)
+    if conexao is None:
+        # isolation_level=None: as transações são abertas explicitamente (BEGIN IMMEDIATE)
+        conexao = sqlite3.connect(ARQUIVO_LIMITES, timeout=5, isolation_level=None)
+        conexao.execute("PRAGMA journal_mode=WAL")
+        conexao.execute("CREATE TABLE IF NOT EXISTS balde ("
+                        "id_cliente INTEGER PRIMARY KEY, tokens REAL NOT NULL, atualizado_em REAL NOT NULL)")
+        conexao.execute("CREATE TABLE IF NOT EXISTS requisicao_ativa (id INTEGER PRIMARY KEY, grupo TEXT NOT NULL, "
+                        "id_cliente INTEGER NOT NULL, inicio REAL NOT NULL)")
+        conexao.execute("CREATE INDEX IF NOT EXISTS ix_requisicao_ativa ON requisicao_ativa (grupo, id_cliente)")
+        _conexao_limites.conexao = conexao
+    return conexao
+
+
+def buscar_limites_cliente(id_cliente):
+    """ Lê os limites do cliente no banco, com cache em memória para não consultar a cada requisição. """
+    agora = time.monotonic()
+    em_cache = _cache_limites.get(id_cliente)
+    if em_cache and em_cache[0] > agora:
+        return em_cache[1], em_cache[2]
+
+    try:
+        linha = db.session.query(Cliente.limite_requisicoes_minuto, Cliente.limite_concorrencia).filter(
+            Cliente.id == id_cliente
+        ).first()
+    except Exception as e:
+        # Banco indisponível: segue com o último valor conhecido (ou os padrões) sem gravar no cache,
+        # e o próprio endpoint responde o erro em JSON se precisar do banco.
+        db.session.rollback()
+        print(f"AVISO: Não foi possível ler os limites do cliente {id_cliente}: {e}")
+        if em_cache:
+            return em_cache[1], em_cache[2]
+        return LIMITE_PADRAO_REQUISICOES_MINUTO, LIMITE_PADRAO_CONCORRENCIA
+    requisicoes_minuto = (linha and linha.limite_requisicoes_minuto) or LIMITE_PADRAO_REQUISICOES_MINUTO
+    concorrencia = (linha and linha.limite_concorrencia) or LIMITE_PADRAO_CONCORRENCIA
+    _cache_limites[id_cliente] = (agora + TEMPO_CACHE_LIMITES, requisicoes_minuto, concorrencia)
+    return requisicoes_minuto, concorrencia
+
+
+def resposta_limite_excedido(mensagem, segundos):
+    return jsonify({"erro": mensagem}), 429, {"Retry-After": str(max(1, int(math.ceil(segundos))))}
+
+
+def inserir_vaga(conexao, grupo, id_cliente, limite_cliente, agora, limite_total=None):
+    """
+    Reserva uma vaga de requisição simultânea no grupo (chamar dentro do BEGIN IMMEDIATE).
+    Retorna o id da vaga ou None se o cliente (ou a máquina, com limite_total) já está no limite.
+    """
+    conexao.execute("DELETE FROM requisicao_ativa WHERE inicio < ?", (agora - TEMPO_MAXIMO_REQUISICAO,))
+    em_andamento = conexao.execute("SELECT COUNT(*) FROM requisicao_ativa WHERE grupo = ? AND id_cliente = ?",
+                                   (grupo, id_cliente)).fetchone()[0]
+    if em_andamento >= limite_cliente:
+        return None
+    if limite_total is not None:
+        total = conexao.execute("SELECT COUNT(*) FROM requisicao_ativa WHERE grupo = ?", (grupo,)).fetchone()[0]
+        if total >= limite_total:
+            return None
+    return conexao.execute("INSERT INTO requisicao_ativa (grupo, id_cliente, inicio) VALUES (?, ?, ?)",
+                           (grupo, id_cliente, agora)).lastrowid
+
+
+def verificar_limites(id_cliente, custo=1, pesada=False):
+    """
+    Token bucket por cliente (capacidade = limite por minuto, recarga contínua) e limite de requisições
+    simultâneas para as pesadas. Retorna a resposta 429 ou None se a requisição pode seguir.
+    """
+    requisicoes_minuto, concorrencia = buscar_limites_cliente(id_cliente)
+    taxa_por_segundo = requisicoes_minuto / 60.0
+    custo = min(custo, requisicoes_minuto)  # Um lote enorme nunca pode ficar bloqueado para sempre
+
+    erro, segundos, id_vaga = None, 0, None
+    try:
+        conexao = conexao_limites()
+        agora = time.time()
+        # BEGIN IMMEDIATE pega a trava de escrita do arquivo: leitura e reserva são atômicas entre os workers
+        conexao.execute("BEGIN IMMEDIATE")
+        try:
+            linha = conexao.execute("SELECT tokens, atualizado_em FROM balde WHERE id_cliente = ?",
+                                    (id_cliente,)).fetchone()
+            tokens, atualizado_em = linha if linha else (float(requisicoes_minuto), agora)
+            tokens = min(float(requisicoes_minuto), tokens + max(0.0, agora - atualizado_em) * taxa_por_segundo)
+            if tokens < custo:
+                erro, segundos = "Limite de requisicoes excedido", (custo - tokens) / taxa_por_segundo
+            elif pesada:
+                id_vaga = inserir_vaga(conexao, 'pesada', id_cliente, concorrencia, agora)
+                if id_vaga is None:
+                    erro, segundos = "Limite de requisicoes simultaneas excedido", 1
+            if not erro:
+                conexao.execute("INSERT OR REPLACE INTO balde (id_cliente, tokens, atualizado_em) VALUES (?, ?, ?)",
+                                (id_cliente, tokens - custo, agora))
+        except Exception:
+            conexao.execute("ROLLBACK")
+            raise
+        conexao.execute("COMMIT")
+    except sqlite3.Error as e:
+        # O controle de admissão não pode derrubar a API: sem o arquivo de limites, a requisição segue
+        print(f"AVISO: Controle de limites indisponível ({ARQUIVO_LIMITES}), requisição liberada: {e}")
+        return None
+
+    if erro:
+        return resposta_limite_excedido(erro, segundos)
+    if id_vaga is not None:
+        g.vaga_requisicao_simultanea = id_vaga
+    return None
+
+
+def reservar_vaga_espera(id_cliente):
+    """
+    Reserva uma vaga de long-poll (statusPesquisa): no máximo LIMITE_ESPERAS_SIMULTANEAS por cliente e
+    LIMITE_ESPERAS_TOTAL somando todos os clientes e workers da máquina. Retorna False se não há vaga
+    (ou se o arquivo de limites está indisponível): o chamador responde na hora, sem segurar o worker.
+    """
+    try:
+        conexao = conexao_limites()
+        conexao.execute("BEGIN IMMEDIATE")
+        try:
+            id_vaga = inserir_vaga(conexao, 'espera', id_cliente, LIMITE_ESPERAS_SIMULTANEAS, time.time(),
+                                   limite_total=LIMITE_ESPERAS_TOTAL)
+        except Exception:
+            conexao.execute("ROLLBACK")
+            raise
+        conexao.execute("COMMIT")
+    except sqlite3.Error as e:
+        print(f"AVISO: Controle de limites indisponível ({ARQUIVO_LIMITES}), status respondido sem espera: {e}")
+        return False
+    if id_vaga is None:
+        return False
+    g.vaga_requisicao_simultanea = id_vaga
+    return True
+
+
+@app.teardown_request
+def liberar_requisicao_pesada(exc):
+    # Roda ao fim da requisição (inclusive depois de uma resposta em streaming)
+    id_vaga = g.pop('vaga_requisicao_simultanea', None)
+    if id_vaga is not None:
+        try:
+            conexao_limites().execute("DELETE FROM requisicao_ativa WHERE id = ?", (id_vaga,))
+        except sqlite3.Error as e:
+            print(f"AVISO: Não foi possível liberar a vaga {id_vaga} (expira em {TEMPO_MAXIMO_REQUISICAO}s): {e}")
+
+
+TAMANHO_BLOCO_IN = 1000  # Itens por consulta IN (fica abaixo do limite de parâmetros do SQLite/PostgreSQL)
+
+
+def dividir_em_blocos(lista, tamanho=TAMANHO_BLOCO_IN):
+    for i in range(0, len(lista), tamanho):
+        yield lista[i:i + tamanho]
+
+
+def ler_data_iso(texto):
+    """ Lê uma data ISO 8601. Com fuso (ex.: "...Z"), converte para UTC sem fuso, como as datas do banco. """
+    data = datetime.datetime.fromisoformat(texto)
+    if data.tzinfo is not None:
+        data = data.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return data
+
+
+TAMANHO_MAXIMO_URL_CALLBACK = 500  # Igual ao tamanho da coluna pesquisa.url_callback
+# Só para desenvolvimento: PERMITIR_CALLBACK_LOCAL=1 aceita callbacks para localhost e IPs internos
+# (ex.: o "http://localhost:9000/callback" do teste.http). Precisa estar ligado na API e no importador.
+PERMITIR_CALLBACK_LOCAL = os.environ.get('PERMITIR_CALLBACK_LOCAL') == '1'
+
+
+def endereco_callback_permitido(endereco):
+    """ True se o IP pode receber callback: só IPs públicos, a menos que PERMITIR_CALLBACK_LOCAL esteja ligado. """
+    try:
+        ip = ipaddress.ip_address(endereco)
+    except ValueError:
+        return False
+    return PERMITIR_CALLBACK_LOCAL or ip.is_global
+
+
+def url_callback_valida(url):
+    """
+    Aceita apenas http/https com host, até TAMANHO_MAXIMO_URL_CALLBACK caracteres, e recusa IPs
+    internos (loopback, rede privada, link-local) para o importador não chamar a própria infraestrutura.
+    Nomes de domínio são aceitos aqui; o IP para onde eles resolvem é conferido no envio (notificar_callback).
+    """
+    if not isinstance(url, str) or len(url) > TAMANHO_MAXIMO_URL_CALLBACK:
+        return False
+    try:
+        partes = urlsplit(url)
+        host = partes.hostname
+    except ValueError:
+        return False
+    if partes.scheme.lower() not in ('http', 'https') or not host:
+        return False
+    if (host == 'localhost' or host.endswith('.localhost')) and not PERMITIR_CALLBACK_LOCAL:
+        return False
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return True  # Nome de domínio
+    return endereco_callback_permitido(host)
+
+
+# --- Réplica de leitura ---
+TEMPO_REPLICA_INDISPONIVEL = 30  # Segundos usando só o primário depois de uma falha na réplica
+_replica_indisponivel_ate = [0.0]
+
+
+def obter_sessao_leitura():
+    """
+    Sessão para as consultas somente-leitura da requisição: usa a réplica (DATABASE_URL_READONLY)
+    quando configurada e disponível; caso contrário, a sessão normal do primário (db.session).
+    Escritas (ex.: CONCLUIDO -> ENTREGUE) devem sempre usar db.session.
+    """
+    if 'sessao_leitura' in g:
+        return g.sessao_leitura
+
+    sessao = db.session
+    if DATABASE_URL_READONLY and time.monotonic() >= _replica_indisponivel_ate[0]:
+        try:
+            g.conexao_leitura = db.engines['leitura'].connect()
+            sessao = Session(bind=g.conexao_leitura)
+        except OperationalError as e:
+            _replica_indisponivel_ate[0] = time.monotonic() + TEMPO_REPLICA_INDISPONIVEL
+            print(f"AVISO: Réplica de leitura indisponível, usando o primário: {e}")
+    g.sessao_leitura = sessao
+    return sessao
+
+
+@app.teardown_request
+def fechar_sessao_leitura(exc):
+    sessao = g.pop('sessao_leitura', None)
+    if sessao is not None and sessao is not db.session:
+        sessao.close()
+    conexao = g.pop('conexao_leitura', None)
+    if conexao is not None:
+        conexao.close()
+
+
+def marcar_como_entregue(ids_pesquisas):
+    """ TÓPICO 1/2: CONCLUIDO -> ENTREGUE (e data de entrega), sempre no banco primário. """
+    for bloco in dividir_em_blocos(list(ids_pesquisas)):
+        Pesquisa.query.filter(Pesquisa.id.in_(bloco), Pesquisa.status == 'CONCLUIDO').update(
+            {"status": 'ENTREGUE', "data_entrega": datetime.datetime.utcnow()},
+            synchronize_session=False
+        )
+    db.session.commit()
+
+
+def obter_ou_criar_processos(numeros):
+    """ Retorna {numero: Processo}, criando no cadastro único apenas os números que ainda não existem. """
+    processos = {}
+    for bloco in dividir_em_blocos(list(numeros)):
+        for processo in Processo.query.filter(Processo.numero_processo.in_(bloco)).all():
+            processos[processo.numero_processo] = processo
+    for num_proc in numeros:
+        if num_proc not in processos:
+            processos[num_proc] = Processo(numero_processo=num_proc)
+            db.session.add(processos[num_proc])
+    return processos
+
+
+# Trava entre o importar_resultados.py, que guarda em cache os ids de rotulo/descricao_andamento durante a
+# importação, e a remoção dos textos sem uso no limpar_dados_antigos.py
+CHAVE_TRAVA_TEXTOS = 330033
+
+
+def travar_textos_repetidos(sessao, exclusiva=False):
+    """
+    Advisory lock do PostgreSQL preso à transação (liberado no commit/rollback). A importação pega a trava
+    compartilhada (espera a limpeza terminar); a limpeza tenta a exclusiva sem esperar e recebe False se houver
+    importação em andamento. Em outros bancos (SQLite local) não trava e retorna True.
+    """
+    if sessao.get_bind().dialect.name != 'postgresql':
+        return True
+    if exclusiva:
+        return sessao.execute(text("SELECT pg_try_advisory_xact_lock(:chave)"),
+                              {"chave": CHAVE_TRAVA_TEXTOS}).scalar()
+    sessao.execute(text("SELECT pg_advisory_xact_lock_shared(:chave)"), {"chave": CHAVE_TRAVA_TEXTOS})
+    return True
+
+
+def validar_token(custo=1, pesada=False):
     token_recebido = request.headers.get('Authorization')
     if not token_recebido:
         return None, (jsonify({"erro": "Header 'Authorization' ausente"}), 401)
     try:
         payload = jwt.decode(token_recebido, APP_SECRET_KEY, algorithms=["HS256"])
-        return payload, None
     except (jwt.ExpiredSignatureError, jwt.InvalidTokenError):
         return None, (jsonify({"erro": "Token invalido ou expirado"}), 401)
 
+    erro_limite = verificar_limites(payload['id_cliente_interno'], custo=custo, pesada=pesada)
+    if erro_limite:
+        return None, erro_limite
+    return payload, None
+
 
 # --- 4. ENDPOINTS DA API ---
 
@@ -156,21 +567,37 @@ def autentica_api():
 
 @app.route('/WebApiDiscoveryFullV2/api/DiscoveryFull/CadastraPesquisa_NumProcessos', methods=['POST'])
 def cadastra_pesquisa():
-    payload, erro = validar_token()
+    dados_pesquisa = request.get_json(silent=True)
+    lista = dados_pesquisa.get('listaNumProcessos') if isinstance(dados_pesquisa, dict) else None
+    custo = 1 + (len(lista) if isinstance(lista, list) else 0) // PROCESSOS_POR_TOKEN
+    payload, erro = validar_token(custo=custo, pesada=True)
     if erro: return erro
+    if not isinstance(dados_pesquisa, dict):
+        return jsonify({"erro": "Formato invalido"}), 400
     try:
         id_cliente_logado = payload['id_cliente_interno']
-        dados_pesquisa = request.get_json()
-        nova_pesquisa = Pesquisa(
-            cliente_id=id_cliente_logado,
-            instancia=dados_pesquisa.get('instancia'),
-            status='PENDENTE'
-        )
-        db.session.add(nova_pesquisa)
-        db.session.commit()
-        for num_proc in dados_pesquisa.get('listaNumProcessos', []):
-            db.session.add(Processo(pesquisa_id=nova_pesquisa.id, numero_processo=num_proc))
-        db.session.commit()
+        numeros = list(dict.fromkeys(dados_pesquisa.get('listaNumProcessos', [])))  # Sem repetidos, na ordem
+        url_callback = dados_pesquisa.get('urlCallback') or None
+        if url_callback is not None and not url_callback_valida(url_callback):
+            return jsonify({"erro": "urlCallback invalida (use http/https, maximo de 500 caracteres)"}), 400
+        for tentativa in range(2):
+            try:
+                nova_pesquisa = Pesquisa(
+                    cliente_id=id_cliente_logado,
+                    instancia=dados_pesquisa.get('instancia'),
+                    status='PENDENTE',
+                    url_callback=url_callback
+                )
+                processos = obter_ou_criar_processos(numeros)
+                nova_pesquisa.processos = [processos[n] for n in numeros]
+                db.session.add(nova_pesquisa)
+                db.session.commit()
+                break
+            except IntegrityError:
+                # Outra requisição criou o mesmo número ao mesmo tempo: tenta de novo reaproveitando o registro
+                db.session.rollback()
+                if tentativa:
+                    raise
         return jsonify({"codPesquisa": nova_pesquisa.id}), 200
     except Exception as e:
         db.session.rollback()
@@ -180,12 +607,13 @@ def cadastra_pesquisa():
 
 @app.route('/WebApiDiscoveryFullV2/api/DiscoveryFull/buscaDadosResultadoPesquisa', methods=['POST'])
 def busca_dados_capa():
-    payload, erro = validar_token()
+    payload, erro = validar_token(pesada=True)
     if erro: return erro
     try:
         dados = request.get_json()
         cod_pesquisa = dados.get('codPesquisa')
-        pesquisa = Pesquisa.query.get(cod_pesquisa)
+        sessao = obter_sessao_leitura()
+        pesquisa = sessao.get(Pesquisa, cod_pesquisa)
         if not pesquisa: return jsonify({"erro": "codPesquisa nao encontrado"}), 404
         if pesquisa.cliente_id != payload['id_cliente_interno']:
             return jsonify({"erro": "Acesso negado a esta pesquisa"}), 403
@@ -197,10 +625,7 @@ def busca_dados_capa():
 
         # Se o status for CONCLUIDO, muda para ENTREGUE e salva a data
         if pesquisa.status == 'CONCLUIDO':
-            pesquisa.status = 'ENTREGUE'
-            pesquisa.data_entrega = datetime.datetime.utcnow()
-            db.session.add(pesquisa)
-            db.session.commit()
+            marcar_como_entregue([pesquisa.id])
 
         # (Se o status for 'ENTREGUE', apenas continua e retorna os dados)
 
@@ -238,12 +663,13 @@ def busca_dados_capa():
 @app.route('/WebApiDiscoveryFullV2/api/DiscoveryFull/buscaDadosDocIniciaisPesquisa', methods=['POST'])
 def busca_docs_iniciais():
     """ Endpoint 4: Recupera Cópia Integral (AGORA COM LINK PRÉ-ASSINADO SEGURO) """
-    payload, erro = validar_token()
+    payload, erro = validar_token(pesada=True)
     if erro: return erro
     try:
         dados = request.get_json()
         cod_pesquisa = dados.get('codPesquisa')
-        pesquisa = Pesquisa.query.get(cod_pesquisa)
+        sessao = obter_sessao_leitura()
+        pesquisa = sessao.get(Pesquisa, cod_pesquisa)
         if not pesquisa: return jsonify({"erro": "codPesquisa nao encontrado"}), 404
         if pesquisa.cliente_id != payload['id_cliente_interno']:
             return jsonify({"erro": "Acesso negado a esta pesquisa"}), 403
@@ -254,10 +680,7 @@ def busca_docs_iniciais():
                             "mensagem": "Os resultados desta pesquisa ainda estão sendo processados."}), 202
 
         if pesquisa.status == 'CONCLUIDO':
-            pesquisa.status = 'ENTREGUE'
-            pesquisa.data_entrega = datetime.datetime.utcnow()
-            db.session.add(pesquisa)
-            db.session.commit()
+            marcar_como_entregue([pesquisa.id])
 
         # (Se o status for 'ENTREGUE', apenas continua e retorna os dados)
 
@@ -272,7 +695,8 @@ def busca_docs_iniciais():
                 's3',
                 aws_access_key_id=aws_access_key,
                 aws_secret_access_key=aws_secret_key,
-                region_name=S3_REGION
+                region_name=S3_REGION,
+                endpoint_url=os.environ.get('S3_ENDPOINT_URL')  # S3 local (MinIO/moto); vazio = AWS
             )
         else:
             s3_client = None
@@ -314,22 +738,21 @@ def busca_andamentos():
     try:
         dados = request.get_json()
         num_processo = dados.get('numeroProcesso')
-        processo = Processo.query.filter_by(numero_processo=num_processo).first()
+        sessao = obter_sessao_leitura()
+        processo = sessao.query(Processo).filter_by(numero_processo=num_processo).first()
         if not processo: return jsonify({"erro": "Processo nao encontrado"}), 404
-        if processo.pesquisa.cliente_id != payload['id_cliente_interno']:
+        pesquisas_cliente = [p for p in processo.pesquisas if p.cliente_id == payload['id_cliente_interno']]
+        if not pesquisas_cliente:
             return jsonify({"erro": "Acesso negado a este processo"}), 403
 
-        # TÓPICO 1: Lógica de Status (aplicada à pesquisa-mãe)
-        pesquisa = processo.pesquisa
-        if pesquisa.status in ('PENDENTE', 'PROCESSANDO'):
+        # TÓPICO 1: Lógica de Status (aplicada às pesquisas do cliente que contêm o processo)
+        if all(p.status in ('PENDENTE', 'PROCESSANDO') for p in pesquisas_cliente):
             return jsonify({"status": "processando",
                             "mensagem": "Os resultados desta pesquisa ainda estão sendo processados."}), 202
 
-        if pesquisa.status == 'CONCLUIDO':
-            pesquisa.status = 'ENTREGUE'
-            pesquisa.data_entrega = datetime.datetime.utcnow()
-            db.session.add(pesquisa)
-            db.session.commit()
+        concluidas = [p.id for p in pesquisas_cliente if p.status == 'CONCLUIDO']
+        if concluidas:
+            marcar_como_entregue(concluidas)
 
         # (Se o status for 'ENTREGUE', apenas continua e retorna os dados)
 
@@ -342,6 +765,286 @@ def busca_andamentos():
         return jsonify({"erro": "Erro interno ao processar"}), 500
 
 
+# --- BUSCA DE ANDAMENTOS EM LOTE ---
+LIMITE_LOTE_STREAMING = 500  # Acima disso a resposta é enviada em streaming
+
+
+def filtro_cursores(desde_por_processo, ids):
+    """
+    Condição SQL "processo do bloco e andamento posterior ao seu cursor". Os processos são agrupados
+    pelo valor de 'desde' (normalmente o mesmo para o lote todo): um IN + "data > desde" por grupo.
+    """
+    ids_por_desde = {}
+    for processo_id in ids:
+        ids_por_desde.setdefault(desde_por_processo[processo_id], []).append(processo_id)
+    condicoes = []
+    for desde, ids_grupo in ids_por_desde.items():
+        if desde is None:
+            condicoes.append(Andamento.processo_id.in_(ids_grupo))
+        else:
+            condicoes.append(and_(Andamento.processo_id.in_(ids_grupo), Andamento.data > desde))
+    return or_(*condicoes)
+
+
+def gerar_json_andamentos_lote(sessao, desde_por_processo, numeros_prontos, processando, nao_encontrados):
+    """ Gera o JSON do lote em pedaços, lendo os andamentos em uma consulta JOIN por bloco de processos. """
+    yield '{"andamentos": {'
+    primeiro = True
+    emitidos = set()
+    for bloco in dividir_em_blocos(sorted(desde_por_processo)):
+        linhas = sessao.query(Processo.numero_processo, Andamento.data, DescricaoAndamento.texto).join(
+            Andamento, Andamento.processo_id == Processo.id
+        ).outerjoin(
+            DescricaoAndamento, Andamento.descricao_id == DescricaoAndamento.id
+        ).filter(
+            filtro_cursores(desde_por_processo, bloco)
+        ).order_by(Processo.numero_processo, Andamento.data, Andamento.id).yield_per(TAMANHO_BLOCO_IN)
+
+        for num_processo, grupo in itertools.groupby(linhas, key=lambda linha: linha[0]):
+            andamentos_json = []
+            for _, data, descricao in grupo:
+                andamentos_json.append({"data": data.isoformat(), "andamento": descricao})
+            yield ('' if primeiro else ', ') + json.dumps(num_processo) + ': ' + json.dumps(andamentos_json)
+            primeiro = False
+            emitidos.add(num_processo)
+
+    # Processos prontos mas sem andamentos (ou sem andamentos novos desde o cursor)
+    for num_processo in numeros_prontos:
+        if num_processo not in emitidos:
+            yield ('' if primeiro else ', ') + json.dumps(num_processo) + ': []'
+            primeiro = False
+
+    yield '}, "processando": ' + json.dumps(processando)
+    yield ', "naoEncontrados": ' + json.dumps(nao_encontrados) + '}'
+
+
+@app.route('/WebApiDiscoveryFullV2/api/DiscoveryFull/buscaAndamentosProcessosLote', methods=['POST'])
+def busca_andamentos_lote():
+    """
+    Versão em lote do buscaAndamentosProcesso.
+    Aceita "listaNumProcessos" (lista de números) e/ou "processos" ([{"numeroProcesso": ..., "desde": ...}]),
+    onde "desde" (ISO 8601, opcional) retorna apenas os andamentos posteriores a essa data.
+    """
+    dados = request.get_json(silent=True)
+    if isinstance(dados, dict):
+        listas = [dados.get('listaNumProcessos'), dados.get('processos')]
+        custo = 1 + sum(len(lista) for lista in listas if isinstance(lista, list)) // PROCESSOS_POR_TOKEN
+    else:
+        custo = 1
+    payload, erro = validar_token(custo=custo, pesada=True)
+    if erro: return erro
+    if not isinstance(dados, dict):
+        return jsonify({"erro": "Formato invalido"}), 400
+    try:
+        id_cliente_logado = payload['id_cliente_interno']
+
+        cursores = {}
+        for num_proc in dados.get('listaNumProcessos', []):
+            cursores[num_proc] = None
+        for item in dados.get('processos', []):
+            desde = item.get('desde')
+            cursores[item.get('numeroProcesso')] = ler_data_iso(desde) if desde else None
+        if not cursores:
+            return jsonify({"erro": "Informe 'listaNumProcessos' ou 'processos'"}), 400
+    except Exception as e:
+        return jsonify({"erro": "Formato invalido"}), 400
+
+    try:
+        # 1. Localiza os processos do cliente (uma consulta IN por bloco, usando o índice de numero_processo)
+        desde_por_processo = {}  # processo_id -> cursor 'desde' (ou None)
+        numeros_prontos = set()
+        numeros_em_processamento = set()
+        pesquisas_concluidas = set()
+        sessao = obter_sessao_leitura()
+        for bloco in dividir_em_blocos(list(cursores)):
+            linhas = sessao.query(Processo.id, Processo.numero_processo, Pesquisa.id, Pesquisa.status).join(
+                pesquisa_processo, pesquisa_processo.c.processo_id == Processo.id
+            ).join(
+                Pesquisa, pesquisa_processo.c.pesquisa_id == Pesquisa.id
+            ).filter(
+                Pesquisa.cliente_id == id_cliente_logado,
+                Processo.numero_processo.in_(bloco)
+            ).all()
+            for processo_id, num_processo, pesquisa_id, status in linhas:
+                # TÓPICO 1: Lógica de Status (aplicada à pesquisa-mãe)
+                if status in ('PENDENTE', 'PROCESSANDO'):
+                    numeros_em_processamento.add(num_processo)
+                    continue
+                if status == 'CONCLUIDO':
+                    pesquisas_concluidas.add(pesquisa_id)
+                desde_por_processo[processo_id] = cursores.get(num_processo)
+                numeros_prontos.add(num_processo)
+
+        processando = [n for n in cursores if n in numeros_em_processamento and n not in numeros_prontos]
+        nao_encontrados = [n for n in cursores if n not in numeros_em_processamento and n not in numeros_prontos]
+
+        # 2. CONCLUIDO -> ENTREGUE em um único UPDATE por bloco (no primário)
+        if pesquisas_concluidas:
+            marcar_como_entregue(pesquisas_concluidas)
+
+        # 3. Monta a resposta (em streaming se o lote for grande)
+        partes_json = gerar_json_andamentos_lote(sessao, desde_por_processo, sorted(numeros_prontos),
+                                                 processando, nao_encontrados)
+        if len(cursores) > LIMITE_LOTE_STREAMING:
+            return Response(stream_with_context(partes_json), status=200, mimetype='application/json')
+        return Response(''.join(partes_json), status=200, mimetype='application/json')
+    except Exception as e:
+        db.session.rollback()
+        print(f"Erro em /buscaAndamentosProcessosLote: {e}")
+        return jsonify({"erro": "Erro interno ao processar"}), 500
+
+
+# --- BUSCA DE TEXTO NOS ANDAMENTOS ---
+TAMANHO_PAGINA_PADRAO = 50
+TAMANHO_PAGINA_MAXIMO = 200
+
+
+def consulta_texto_andamentos(sessao, termo, *colunas):
+    """
+    Monta a consulta de andamentos que contêm o termo, usando o índice de texto do banco em uso.
+    Retorna (consulta com as colunas pedidas + 'relevancia', ordem da relevância).
+    """
+    dialeto = sessao.get_bind().dialect.name
+    if dialeto == 'postgresql':
+        # Mesma expressão do índice ix_descricao_andamento_fts (senão o PostgreSQL não usa o índice)
+        vetor = func.to_tsvector(literal_column(f"'{CONFIGURACAO_BUSCA_TEXTO}'"), DescricaoAndamento.texto)
+        termos = func.plainto_tsquery(literal_column(f"'{CONFIGURACAO_BUSCA_TEXTO}'"), termo)
+        consulta = sessao.query(*colunas, func.ts_rank(vetor, termos).label('relevancia')).select_from(
+            Andamento
+        ).join(
+            DescricaoAndamento, Andamento.descricao_id == DescricaoAndamento.id
+        ).filter(vetor.op('@@')(termos))
+        return consulta, text('relevancia DESC')
+    if dialeto == 'sqlite':
+        # Cada palavra vira um termo entre aspas (todas precisam aparecer), como no plainto_tsquery
+        termos = ' '.join('"' + palavra.replace('"', '""') + '"' for palavra in termo.split())
+        descricao_fts = table('descricao_andamento_fts', column('rowid'))
+        consulta = sessao.query(
+            *colunas, func.bm25(literal_column('descricao_andamento_fts')).label('relevancia')
+        ).select_from(
+            Andamento
+        ).join(
+            DescricaoAndamento, Andamento.descricao_id == DescricaoAndamento.id
+        ).join(
+            descricao_fts, descricao_fts.c.rowid == DescricaoAndamento.id
+        ).filter(text("descricao_andamento_fts MATCH :termos").bindparams(termos=termos))
+        return consulta, text('relevancia ASC')  # bm25: quanto menor, mais relevante
+    # Outros bancos: sem índice de texto, apenas LIKE
+    consulta = sessao.query(*colunas, literal(0).label('relevancia')).select_from(Andamento).join(
+        DescricaoAndamento, Andamento.descricao_id == DescricaoAndamento.id
+    ).filter(DescricaoAndamento.texto.ilike(f"%{termo}%"))
+    return consulta, text('relevancia DESC')
+
+
+@app.route('/WebApiDiscoveryFullV2/api/DiscoveryFull/buscaTextoAndamentos', methods=['POST'])
+def busca_texto_andamentos():
+    """
+    Busca por texto nos andamentos dos processos do cliente (ex.: "sentença"), com filtro opcional
+    de período ("dataInicio"/"dataFim", ISO 8601) e resultados ordenados por relevância e paginados.
+    """
+    payload, erro = validar_token(pesada=True)
+    if erro: return erro
+    try:
+        dados = request.get_json()
+        termo = (dados.get('texto') or '').strip()
+        if not termo:
+            return jsonify({"erro": "Informe 'texto'"}), 400
+        data_inicio = ler_data_iso(dados['dataInicio']) if dados.get('dataInicio') else None
+        data_fim = ler_data_iso(dados['dataFim']) if dados.get('dataFim') else None
+        pagina = max(1, int(dados.get('pagina', 1)))
+        tamanho_pagina = min(max(1, int(dados.get('tamanhoPagina', TAMANHO_PAGINA_PADRAO))), TAMANHO_PAGINA_MAXIMO)
+    except Exception as e:
+        return jsonify({"erro": "Formato invalido"}), 400
+
+    try:
+        sessao = obter_sessao_leitura()
+        consulta, ordem_relevancia = consulta_texto_andamentos(
+            sessao, termo, Processo.numero_processo, Andamento.data, DescricaoAndamento.texto
+        )
+
+        # Apenas processos de pesquisas do cliente que já têm resultado (mesma regra dos outros endpoints)
+        do_cliente = exists().where(and_(
+            pesquisa_processo.c.processo_id == Processo.id,
+            pesquisa_processo.c.pesquisa_id == Pesquisa.id,
+            Pesquisa.cliente_id == payload['id_cliente_interno'],
+            Pesquisa.status.in_(('CONCLUIDO', 'ENTREGUE'))
+        ))
+        consulta = consulta.join(Processo, Andamento.processo_id == Processo.id).filter(do_cliente)
+        if data_inicio:
+            consulta = consulta.filter(Andamento.data >= data_inicio)
+        if data_fim:
+            consulta = consulta.filter(Andamento.data <= data_fim)
+
+        # Busca um item a mais para saber se existe próxima página
+        linhas = consulta.order_by(ordem_relevancia, Andamento.data.desc(), Andamento.id.desc()).offset(
+            (pagina - 1) * tamanho_pagina
+        ).limit(tamanho_pagina + 1).all()
+
+        resultados = []
+        for num_processo, data, descricao, valor_relevancia in linhas[:tamanho_pagina]:
+            resultados.append({
+                "numeroProcesso": num_processo, "data": data.isoformat(), "andamento": descricao,
+                "relevancia": abs(float(valor_relevancia or 0))
+            })
+        return jsonify({"pagina": pagina, "tamanhoPagina": tamanho_pagina,
+                        "temMaisResultados": len(linhas) > tamanho_pagina, "resultados": resultados}), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"Erro em /buscaTextoAndamentos: {e}")
+        return jsonify({"erro": "Erro interno ao processar"}), 500
+
+
+# --- STATUS DA PESQUISA (LONG-POLLING) ---
+# Cada espera prende o worker que atende a requisição: com workers sync (padrão do gunicorn) um long-poll
+# bloqueia um processo inteiro. Para usar a espera, suba o gunicorn com threads ou gevent, por exemplo
+# "gunicorn app:app --worker-class gthread --workers 2 --threads 8", e mantenha LIMITE_ESPERAS_TOTAL abaixo
+# do total de threads. Sem vaga de espera, o status é respondido na hora (o cliente consulta de novo).
+TEMPO_MAXIMO_ESPERA = int(os.environ.get('TEMPO_MAXIMO_ESPERA', 10))  # Segundos que uma requisição pode aguardar
+INTERVALO_CONSULTA_STATUS = 1  # Segundos entre cada consulta ao banco durante a espera
+
+
+@app.route('/WebApiDiscoveryFullV2/api/DiscoveryFull/statusPesquisa', methods=['POST'])
+def status_pesquisa():
+    """
+    Retorna apenas o status da pesquisa (sem carregar resultados e sem mudar o status para ENTREGUE).
+    Long-polling: se "statusAtual" for enviado, segura a resposta até o status mudar ou até
+    "aguardarSegundos" (máx. TEMPO_MAXIMO_ESPERA) passar, se houver vaga de espera (reservar_vaga_espera).
+    """
+    payload, erro = validar_token()
+    if erro: return erro
+    try:
+        dados = request.get_json()
+        cod_pesquisa = dados.get('codPesquisa')
+        status_conhecido = dados.get('statusAtual')
+        espera = min(float(dados.get('aguardarSegundos', TEMPO_MAXIMO_ESPERA)), TEMPO_MAXIMO_ESPERA)
+    except Exception as e:
+        return jsonify({"erro": "Formato invalido"}), 400
+
+    try:
+        sessao = obter_sessao_leitura()
+        linha = sessao.query(Pesquisa.cliente_id, Pesquisa.status).filter(Pesquisa.id == cod_pesquisa).first()
+        if not linha: return jsonify({"erro": "codPesquisa nao encontrado"}), 404
+        if linha.cliente_id != payload['id_cliente_interno']:
+            return jsonify({"erro": "Acesso negado a esta pesquisa"}), 403
+
+        status = linha.status
+        if status_conhecido and status == status_conhecido and espera > 0 and \
+                reservar_vaga_espera(payload['id_cliente_interno']):
+            limite = time.monotonic() + espera
+            while status == status_conhecido and time.monotonic() < limite:
+                # Encerra a transação para enxergar o commit do importador na próxima consulta
+                sessao.rollback()
+                time.sleep(INTERVALO_CONSULTA_STATUS)
+                status = sessao.query(Pesquisa.status).filter(Pesquisa.id == cod_pesquisa).scalar()
+
+        return jsonify({"codPesquisa": cod_pesquisa, "status": status,
+                        "alterado": bool(status_conhecido) and status != status_conhecido}), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"Erro em /statusPesquisa: {e}")
+        return jsonify({"erro": "Erro interno ao processar"}), 500
+
+
 # --- ROTA TEMPORÁRIA DE SETUP (CRIA/APAGA TABELAS E CLIENTES) ---
 @app.route('/admin/setup-database/criaaiconsult2025')
 def setup_database():
@@ -352,12 +1055,12 @@ def setup_database():
         with app.app_context():
             # --- PASSO 1: APAGAR TUDO (PARA GARANTIR UMA RECRIAÇÃO LIMPA) ---
             print("AVISO: Apagando todas as tabelas (db.drop_all())...")
-            db.drop_all()
+            db.drop_all(bind_key=None)  # Só o primário (a réplica de leitura, se houver, é replicada dele)
             print("Tabelas apagadas.")
 
             # --- PASSO 2: CRIAR AS TABELAS (e colunas novas) ---
             print("Criando tabelas (db.create_all())...")
-            db.create_all()
+            db.create_all(bind_key=None)
             print("Tabelas criadas com sucesso (com os nomes corrigidos).")
 
             # --- PASSO 3: POPULAR O CLIENTE 1 e 2 ---
@@ -383,6 +1086,99 @@ def setup_database():
 # --- FIM DA ROTA DE SETUP ---
 
 
+# --- ESTATÍSTICAS OPERACIONAIS (ADMIN) ---
+DIAS_PARA_LIMPEZA = 7  # Pesquisas entregues há mais de 7 dias são apagadas pelo limpar_dados_antigos.py
+
+
+def calcular_estatisticas(sessao):
+    """
+    Resumo operacional calculado no banco com agregações (GROUP BY), em 2 consultas
+    independentemente do tamanho das tabelas. Usado pela rota de admin, pelo comando
+    'flask estatisticas' e pelo diagnóstico do exportar_pendentes.py.
+    """
+    agora = datetime.datetime.utcnow()
+    limite_limpeza = agora - datetime.timedelta(days=DIAS_PARA_LIMPEZA)
+
+    # 1. Pesquisas por cliente e status (com a data de criação mais antiga de cada grupo)
+    linhas = sessao.query(
+        Cliente.nome_relacional, Pesquisa.status, func.count(Pesquisa.id), func.min(Pesquisa.data_criacao)
+    ).join(
+        Cliente, Pesquisa.cliente_id == Cliente.id
+    ).group_by(Cliente.nome_relacional, Pesquisa.status).all()
+
+    # 2. Totais de processos e pesquisas prontas para limpeza (subconsultas escalares em um único SELECT)
+    totais = sessao.execute(select(
+        select(func.count(Processo.id)).scalar_subquery().label('processos'),
+        select(func.coalesce(func.sum(case((Processo.dados_processo_encontrado == True, 1), else_=0)), 0)
+               ).scalar_subquery().label('processos_com_dados'),
+        select(func.count()).select_from(pesquisa_processo).scalar_subquery().label('ligacoes'),
+        select(func.count(Pesquisa.id)).where(
+            Pesquisa.status == 'ENTREGUE', Pesquisa.data_entrega < limite_limpeza
+        ).scalar_subquery().label('para_limpeza'),
+    )).one()
+
+    por_status = {}
+    por_cliente = {}
+    mais_antigas = {}
+    for nome_cliente, status, quantidade, data_mais_antiga in linhas:
+        por_status[status] = por_status.get(status, 0) + quantidade
+        por_cliente.setdefault(nome_cliente, {})[status] = quantidade
+        if status in ('PENDENTE', 'PROCESSANDO') and data_mais_antiga:
+            if status not in mais_antigas or data_mais_antiga < mais_antigas[status]:
+                mais_antigas[status] = data_mais_antiga
+
+    return {
+        "geradoEm": agora.isoformat(),
+        "pesquisasPorStatus": por_status,
+        "pesquisasPorCliente": por_cliente,
+        "pesquisaMaisAntiga": {
+            status: {"dataCriacao": data.isoformat(), "idadeHoras": round((agora - data).total_seconds() / 3600, 1)}
+            for status, data in mais_antigas.items()
+        },
+        "processos": {
+            "total": totais.processos,
+            "comDados": totais.processos_com_dados,
+            "ligacoesComPesquisas": totais.ligacoes,
+        },
+        "pesquisasParaLimpeza": totais.para_limpeza,
+    }
+
+
+def imprimir_estatisticas(estatisticas):
+    print("\n--- ESTATÍSTICAS ---")
+    print(f"Gerado em: {estatisticas['geradoEm']} (UTC)")
+    print("\nPesquisas por status:")
+    for status, quantidade in sorted(estatisticas['pesquisasPorStatus'].items()):
+        print(f"  {status}: {quantidade}")
+    print("\nPesquisas por cliente:")
+    for nome_cliente, contagem in sorted(estatisticas['pesquisasPorCliente'].items()):
+        print(f"  {nome_cliente}: " + ", ".join(f"{s}={n}" for s, n in sorted(contagem.items())))
+    for status, info in estatisticas['pesquisaMaisAntiga'].items():
+        print(f"\nMais antiga em {status}: criada em {info['dataCriacao']} ({info['idadeHoras']} h)")
+    processos = estatisticas['processos']
+    print(f"\nProcessos: {processos['total']} (com dados: {processos['comDados']}, "
+          f"ligações com pesquisas: {processos['ligacoesComPesquisas']})")
+    print(f"Pesquisas prontas para limpeza (> {DIAS_PARA_LIMPEZA} dias entregues): "
+          f"{estatisticas['pesquisasParaLimpeza']}")
+
+
+@app.route('/admin/estatisticas/criaaiconsult2025')
+def estatisticas_admin():
+    """ Endpoint de admin. Resumo operacional (contagens agregadas, sem carregar as tabelas). """
+    try:
+        return jsonify(calcular_estatisticas(obter_sessao_leitura())), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"Erro nas estatísticas: {e}")
+        return jsonify({"status": "erro", "mensagem": str(e)}), 500
+
+
+@app.cli.command('estatisticas')
+def estatisticas_cli():
+    """ Imprime o resumo operacional: flask --app app estatisticas """
+    imprimir_estatisticas(calcular_estatisticas(db.session))
+
+
 # --- 5. RODE O SERVIDOR ---
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
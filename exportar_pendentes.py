@@ -1,5 +1,7 @@
 import pandas as pd
 import sys
+import os
+import argparse
 import datetime
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
@@ -14,7 +16,7 @@ except ImportError:
 
 try:
     from app import Cliente, Pesquisa, Processo, db as original_db, CapaProcesso, DocumentoInicial, Andamento, Parte, \
-        Advogado
+        Advogado, calcular_estatisticas, imprimir_estatisticas
     from flask import Flask
 
     app = Flask(__name__)
@@ -26,11 +28,11 @@ except ImportError:
 
 # --- FUNÇÕES HELPER PARA CONEXÃO E DIAGNÓSTICO ---
 
-def get_remote_session():
-    """ Cria uma sessão de banco de dados conectada ao PostgreSQL do Render. """
+def get_remote_session(database_url=None):
+    """ Cria uma sessão de banco de dados conectada ao PostgreSQL do Render (ou à URL informada). """
     print(f"Conectando ao banco de dados remoto...")
 
-    url = DATABASE_URL_REMOTE
+    url = database_url or DATABASE_URL_REMOTE
 
     try:
         engine = create_engine(url)
@@ -46,11 +48,14 @@ def get_remote_session():
                 'cliente',
                 'pesquisa',
                 'processo',
+                'pesquisa_processo',
                 'capaprocessp',  # Nome exato do erro
                 'documentoinicial',  # Nome exato do erro
                 'andamento',
                 'parte',
-                'advogado'
+                'advogado',
+                'rotulo',
+                'descricao_andamento'
             ])
     except Exception as e:
         print(f"ERRO: Falha no mapeamento (Reflect). O Deploy no Render foi concluído?")
@@ -63,10 +68,11 @@ def get_remote_session():
     return Session()
 
 
-def exportar_para_excel():
+def exportar_para_excel(database_url=None, pasta_saida='.'):
+    """ Exporta as pesquisas PENDENTES para Excel. Retorna o caminho do arquivo criado (ou None). """
     session = None
     try:
-        session = get_remote_session()
+        session = get_remote_session(database_url)
         print("Iniciando diagnóstico de status...")
 
         # 1. Tenta buscar pesquisas com o status 'PENDENTE' (o status esperado)
@@ -77,9 +83,22 @@ def exportar_para_excel():
                 f"SUCESSO: Encontradas {len(pesquisas_pendentes_direto)} pesquisas com o status 'PENDENTE'. Exportando...")
 
             # --- LÓGICA DE EXPORTAÇÃO ---
+            # Cada número sai UMA vez por ciclo, mesmo que várias pesquisas (de um ou mais clientes) o peçam.
+            # O codPesquisa exportado é o da primeira pesquisa que pediu o número; o importar_resultados.py
+            # grava o resultado no cadastro único e o entrega a todas as pesquisas ligadas a ele.
+            # Cada número exportado guarda o lote (nome do arquivo): o importar_resultados.py usa o lote para
+            # saber quais números o robô já pesquisou, mesmo os que ele não encontrou. Um número que ainda
+            # espera o resultado de um lote anterior não é reenviado (a pesquisa nova é concluída com aquele lote).
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            lote = f"pendentes_{timestamp}"
             dados_para_exportar = []
-            for pesquisa in pesquisas_pendentes_direto:
+            numeros_exportados = set()
+            for pesquisa in sorted(pesquisas_pendentes_direto, key=lambda p: p.id):
                 for processo in pesquisa.processos:
+                    if processo.numero_processo in numeros_exportados or processo.lote_exportacao:
+                        continue
+                    numeros_exportados.add(processo.numero_processo)
+                    processo.lote_exportacao = lote
                     dados_para_exportar.append({
                         "codPesquisa": pesquisa.id,
                         "numeroProcesso": processo.numero_processo,
@@ -93,32 +112,21 @@ def exportar_para_excel():
 
             if dados_para_exportar:
                 df = pd.DataFrame(dados_para_exportar)
-                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                filename = f"pendentes_{timestamp}.xlsx"
+                filename = os.path.join(pasta_saida, f"{lote}.xlsx")
                 df.to_excel(filename, index=False, engine='openpyxl')
                 print(f"SUCESSO: Relatório '{filename}' criado. Status alterado para PROCESSANDO.")
+                return filename
             return
 
         print("\n--- DIAGNÓSTICO DE STATUS ---\n")
-        print("AVISO: Nenhuma pesquisa PENDENTE encontrada. Buscando TODOS os status para diagnóstico...")
+        print("AVISO: Nenhuma pesquisa PENDENTE encontrada. Resumo do banco:")
 
-        # 2. Se a busca por 'PENDENTE' falhar, buscamos TODOS os itens
-        todas_as_pesquisas = session.query(Pesquisa).all()
-
-        if not todas_as_pesquisas:
+        # 2. Diagnóstico com contagens agregadas no banco (não carrega as pesquisas uma a uma)
+        estatisticas = calcular_estatisticas(session)
+        if not estatisticas['pesquisasPorStatus']:
             print("NÃO ENCONTRADO: Nenhuma pesquisa (em qualquer status) foi encontrada no banco de dados.")
             return
-
-        # Imprime o status real de cada item no banco
-        status_contagem = {}
-        for pesquisa in todas_as_pesquisas:
-            status = pesquisa.status
-            status_contagem[status] = status_contagem.get(status, 0) + 1
-            print(f"PESQUISA ID: {pesquisa.id} | STATUS REAL: {status}")
-
-        print("\nRESUMO DO DIAGNÓSTICO:")
-        for status, count in status_contagem.items():
-            print(f"STATUS ENCONTRADO: '{status}' ({count} itens)")
+        imprimir_estatisticas(estatisticas)
 
     except Exception as e:
         if session:
@@ -131,4 +139,8 @@ def exportar_para_excel():
 
 if __name__ == '__main__':
     # Antes de rodar, crie um pedido usando a Requisição 2 no teste.http (na nuvem)
-    exportar_para_excel()
+    parser = argparse.ArgumentParser(description="Exporta as pesquisas PENDENTES para o robô.")
+    parser.add_argument('--database-url', help="URL do banco (padrão: DATABASE_URL_REMOTE do config_local.py)")
+    parser.add_argument('--pasta-saida', default='.', help="Pasta onde o Excel é criado")
+    args = parser.parse_args()
+    exportar_para_excel(database_url=args.database_url, pasta_saida=args.pasta_saida)
@@ -2,15 +2,23 @@ import pandas as pd
 import re
 import sys
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, exists, and_
 import datetime
 import os
+import json
+import argparse
+import hashlib
+import socket
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # --- IMPORTAÇÃO DE CLASSES E CONFIGURAÇÕES ---
 # Importa as classes de modelo (Pesquisa, Processo, etc.) do app.py
 try:
     from app import Cliente, Pesquisa, Processo, CapaProcesso, DocumentoInicial, Andamento, Parte, Advogado, \
-        db as original_db
+        Rotulo, DescricaoAndamento, db as original_db, dividir_em_blocos, pesquisa_processo, \
+        travar_textos_repetidos, url_callback_valida, endereco_callback_permitido
     from flask import Flask  # Necessário para criar o contexto de metadados
 
     app = Flask(__name__)
@@ -26,17 +34,21 @@ except ImportError:
     sys.exit(1)
 
 
+TIMEOUT_CALLBACK = 10  # Segundos de espera pela resposta do webhook do cliente
+CALLBACKS_SIMULTANEOS = 8  # Webhooks enviados em paralelo
+TEMPO_MAXIMO_CALLBACKS = 60  # Segundos, no total, para enviar os webhooks de uma importação
+
+
 # --- FUNÇÕES HELPER PARA CONEXÃO E DADOS ---
 
-def get_remote_session():
-    """ Cria uma sessão de banco de dados conectada ao PostgreSQL do Render. """
+def get_remote_session(database_url=None):
+    """ Cria uma sessão de banco de dados conectada ao PostgreSQL do Render (ou à URL informada). """
     print(f"Conectando ao banco de dados remoto...")
 
+    url = database_url or DATABASE_URL_REMOTE
     # Ajusta o prefixo de conexão (PostgreSQL precisa do 'postgresql://')
-    if DATABASE_URL_REMOTE.startswith("postgres://"):
-        url = DATABASE_URL_REMOTE.replace("postgres://", "postgresql://", 1)
-    else:
-        url = DATABASE_URL_REMOTE
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
 
     engine = create_engine(url)
 
@@ -58,133 +70,295 @@ def extrair_oab(texto):
     return texto.strip(), None
 
 
+# --- TEXTOS REPETIDOS (tipos, classe, área e descrições de andamento) ---
+# Cache em memória texto -> id, para não consultar o banco a cada linha da planilha.
+# É recarregado a cada importação (carregar_cache_textos).
+_cache_rotulos = {}
+_cache_descricoes = {}
+
+
+def hash_texto(texto):
+    return hashlib.sha1(texto.encode('utf-8')).hexdigest()
+
+
+def carregar_cache_textos(session, df):
+    """ Pré-carrega, em poucas consultas, os rótulos e as descrições da planilha que já existem no banco. """
+    _cache_rotulos.clear()
+    _cache_descricoes.clear()
+    for rotulo_id, valor in session.query(Rotulo.id, Rotulo.valor):
+        _cache_rotulos[valor] = rotulo_id
+
+    if 'andamentoDescricao' in df.columns:
+        por_hash = {hash_texto(str(t)): str(t) for t in df['andamentoDescricao'].dropna().unique()}
+        for bloco in dividir_em_blocos(list(por_hash)):
+            for descricao_id, hash_existente in session.query(DescricaoAndamento.id, DescricaoAndamento.hash_texto).filter(
+                    DescricaoAndamento.hash_texto.in_(bloco)):
+                _cache_descricoes[por_hash[hash_existente]] = descricao_id
+
+
+def texto_ou_vazio(valor):
+    return "" if valor is None or pd.isna(valor) else valor
+
+
+def obter_id_rotulo(session, valor):
+    """ Id do rótulo na tabela 'rotulo' (criando se for novo). NaN/None -> None. """
+    if valor is None or pd.isna(valor):
+        return None
+    valor = str(valor)
+    if valor not in _cache_rotulos:
+        rotulo_id = session.query(Rotulo.id).filter_by(valor=valor).scalar()
+        if rotulo_id is None:
+            novo_rotulo = Rotulo(valor=valor)
+            session.add(novo_rotulo)
+            session.flush()
+            rotulo_id = novo_rotulo.id
+        _cache_rotulos[valor] = rotulo_id
+    return _cache_rotulos[valor]
+
+
+def obter_id_descricao(session, texto):
+    """ Id da descrição na tabela 'descricao_andamento' (criando se for nova). NaN/None -> None. """
+    if texto is None or pd.isna(texto):
+        return None
+    texto = str(texto)
+    if texto not in _cache_descricoes:
+        hash_descricao = hash_texto(texto)
+        descricao_id = session.query(DescricaoAndamento.id).filter_by(hash_texto=hash_descricao).scalar()
+        if descricao_id is None:
+            nova_descricao = DescricaoAndamento(hash_texto=hash_descricao, texto=texto)
+            session.add(nova_descricao)
+            session.flush()
+            descricao_id = nova_descricao.id
+        _cache_descricoes[texto] = descricao_id
+    return _cache_descricoes[texto]
+
+
+def notificar_callback(cod_pesquisa, url_callback):
+    """
+    Avisa o cliente (webhook) que a pesquisa foi CONCLUIDA. Falhas apenas geram log.
+    A URL é validada de novo e o nome é resolvido aqui: todos os IPs precisam ser permitidos
+    (endereco_callback_permitido) e a conexão é feita no IP conferido, para o DNS não trocar o destino
+    depois do cadastro. Redirecionamentos não são seguidos.
+    """
+    if not url_callback_valida(url_callback):
+        print(f"  AVISO: Callback da pesquisa {cod_pesquisa} ignorado (URL recusada): {url_callback}")
+        return
+    partes = urlsplit(url_callback)
+    https = partes.scheme.lower() == 'https'
+    try:
+        porta = partes.port or (443 if https else 80)
+        enderecos = [info[4][0] for info in socket.getaddrinfo(partes.hostname, porta, type=socket.SOCK_STREAM)]
+    except (OSError, ValueError) as e:
+        print(f"  AVISO: Falha ao resolver o callback da pesquisa {cod_pesquisa} ({url_callback}): {e}")
+        return
+    if not enderecos or not all(endereco_callback_permitido(endereco.split('%')[0]) for endereco in enderecos):
+        print(f"  AVISO: Callback da pesquisa {cod_pesquisa} ignorado (resolve para IP interno): {url_callback}")
+        return
+
+    def conectar_no_ip_validado(destino, *args):
+        # Host e SNI continuam com o nome; só o socket é aberto em um dos IPs validados
+        erro = None
+        for endereco in enderecos:
+            try:
+                return socket.create_connection((endereco, destino[1]), *args)
+            except OSError as e:
+                erro = e
+        raise erro
+
+    classe = http.client.HTTPSConnection if https else http.client.HTTPConnection
+    conexao = classe(partes.hostname, porta, timeout=TIMEOUT_CALLBACK)
+    conexao._create_connection = conectar_no_ip_validado
+    caminho = (partes.path or '/') + (f"?{partes.query}" if partes.query else '')
+    corpo = json.dumps({"codPesquisa": int(cod_pesquisa), "status": "CONCLUIDO"}).encode('utf-8')
+    try:
+        conexao.request('POST', caminho, body=corpo, headers={'Content-Type': 'application/json'})
+        resposta = conexao.getresponse()
+        print(f"  Callback da pesquisa {cod_pesquisa} enviado ({resposta.status}).")
+    except Exception as e:
+        print(f"  AVISO: Falha ao enviar callback da pesquisa {cod_pesquisa} para {url_callback}: {e}")
+    finally:
+        conexao.close()
+
+
+def enviar_callbacks(callbacks_pendentes):
+    """
+    Envia os webhooks em paralelo (até CALLBACKS_SIMULTANEOS), com limite de TEMPO_MAXIMO_CALLBACKS
+    para o conjunto: os que não começaram até lá são descartados (o cliente ainda pode consultar o status).
+    """
+    if not callbacks_pendentes:
+        return
+    executor = ThreadPoolExecutor(max_workers=CALLBACKS_SIMULTANEOS)
+    envios = {executor.submit(notificar_callback, cod, url): cod for cod, url in callbacks_pendentes}
+    _, pendentes = wait(envios, timeout=TEMPO_MAXIMO_CALLBACKS)
+    executor.shutdown(wait=False, cancel_futures=True)
+    if pendentes:
+        codigos = sorted(envios[envio] for envio in pendentes)
+        print(f"  AVISO: Tempo máximo dos callbacks esgotado; não enviados/sem resposta: {codigos}")
+
+
 # --- FUNÇÃO PRINCIPAL DE IMPORTAÇÃO ---
 
-def importar_de_excel_v5():
+def importar_de_excel_v5(database_url=None, arquivo="resultados.xlsx"):
+    """ Retorna o número de linhas da planilha importadas, ou None se a importação falhou (erro no log). """
     print("Iniciando importação de resultados (Remoto)...")
 
     try:
-        df = pd.read_excel("resultados.xlsx")
+        df = pd.read_excel(arquivo)
     except FileNotFoundError:
-        print("ERRO: Arquivo 'resultados.xlsx' não encontrado. Crie-o antes de rodar.")
+        print(f"ERRO: Arquivo '{arquivo}' não encontrado. Crie-o antes de rodar.")
         return
     except Exception as e:
         print(f"ERRO ao ler o Excel: {e}")
         return
 
     session = None
+    callbacks_pendentes = []
     try:
-        session = get_remote_session()
-
-        # Agrupa por 'codPesquisa' para processamento
-        for cod_pesquisa, group in df.groupby('codPesquisa'):
-
-            print(f"Processando codPesquisa: {cod_pesquisa}...")
-
-            pesquisa_db = session.query(Pesquisa).get(int(cod_pesquisa))
-            if not pesquisa_db:
-                print(f"  Aviso: codPesquisa {cod_pesquisa} não encontrado no banco. Pulando.")
+        session = get_remote_session(database_url)
+        # Impede a limpeza de apagar, durante a importação, um texto cujo id já está no cache
+        travar_textos_repetidos(session)
+        carregar_cache_textos(session, df)
+
+        # Agrupa por 'numeroProcesso': cada número tem um único registro (compartilhado entre pesquisas).
+        # O 'codPesquisa' da planilha não é mais necessário para localizar o processo.
+        processos_importados = set()
+        lotes_respondidos = set()
+        for num_processo, proc_group in df.groupby('numeroProcesso'):
+
+            processo_db = session.query(Processo).filter(
+                Processo.numero_processo == str(num_processo)
+            ).first()
+
+            if not processo_db:
+                print(f"  Aviso: Processo {num_processo} não encontrado. Pulando.")
                 continue
 
-            # Dentro de cada pesquisa, agrupa por 'numeroProcesso'
-            for num_processo, proc_group in group.groupby('numeroProcesso'):
-
-                processo_db = session.query(Processo).filter(
-                    Processo.pesquisa_id == pesquisa_db.id,
-                    Processo.numero_processo == num_processo
-                ).first()
-
-                if not processo_db:
-                    print(f"  Aviso: Processo {num_processo} não encontrado. Pulando.")
-                    continue
-
-                print(f"  Atualizando processo: {num_processo} (ID: {processo_db.id})")
-
-                # Pega a *primeira* linha do grupo que contenha dados para Capa, Partes, etc.
-                primeira_linha = proc_group.iloc[0]
-
-                # --- 1. CAPA ---
-                capa_existente = session.query(CapaProcesso).filter_by(processo_id=processo_db.id).first()
-                if not capa_existente and pd.notna(primeira_linha.get('valorCausa')):
-                    nova_capa = CapaProcesso(
+            print(f"  Atualizando processo: {num_processo} (ID: {processo_db.id})")
+            if processo_db.lote_exportacao:
+                lotes_respondidos.add(processo_db.lote_exportacao)
+
+            # Pega a *primeira* linha do grupo que contenha dados para Capa, Partes, etc.
+            primeira_linha = proc_group.iloc[0]
+
+            # --- 1. CAPA ---
+            capa_existente = session.query(CapaProcesso).filter_by(processo_id=processo_db.id).first()
+            if not capa_existente and pd.notna(primeira_linha.get('valorCausa')):
+                nova_capa = CapaProcesso(
+                    processo_id=processo_db.id,
+                    valor_causa=primeira_linha.get('valorCausa'),
+                    # Sem valor na planilha -> "" (como o antigo default das colunas classe_cnj/area)
+                    classe_cnj_id=obter_id_rotulo(session, texto_ou_vazio(primeira_linha.get('classeCNJ'))),
+                    area_id=obter_id_rotulo(session, texto_ou_vazio(primeira_linha.get('area')))
+                )
+                session.add(nova_capa)
+                print(f"    -> Capa criada.")
+
+            # --- 2. PDF (URL S3) ---
+            link_pdf = primeira_linha.get('pdfURL')
+            if pd.notna(link_pdf):
+                doc_existente = session.query(DocumentoInicial).filter_by(processo_id=processo_db.id,
+                                                                          link_documento=link_pdf).first()
+                if not doc_existente:
+                    novo_doc = DocumentoInicial(
                         processo_id=processo_db.id,
-                        valor_causa=primeira_linha.get('valorCausa'),
-                        classe_cnj=primeira_linha.get('classeCNJ'),
-                        area=primeira_linha.get('area')
+                        link_documento=link_pdf,  # Salva o link S3 completo
+                        documento_encontrado=True
                     )
-                    session.add(nova_capa)
-                    print(f"    -> Capa criada.")
-
-                # --- 2. PDF (URL S3) ---
-                link_pdf = primeira_linha.get('pdfURL')
-                if pd.notna(link_pdf):
-                    doc_existente = session.query(DocumentoInicial).filter_by(processo_id=processo_db.id,
-                                                                              link_documento=link_pdf).first()
-                    if not doc_existente:
-                        novo_doc = DocumentoInicial(
-                            processo_id=processo_db.id,
-                            link_documento=link_pdf,  # Salva o link S3 completo
-                            documento_encontrado=True
-                        )
-                        session.add(novo_doc)
-                        print(f"    -> Link S3 salvo.")
-
-                # --- 3. PARTES ---
-                partes_texto = primeira_linha.get('partes')
-                if pd.notna(partes_texto):
-                    partes_lista = str(partes_texto).split('|')
-                    for p in partes_lista:
-                        try:
-                            tipo, nome = p.split(':', 1)
-                            # Verifica se a parte já existe para evitar duplicatas
-                            parte_existente = session.query(Parte).filter_by(processo_id=processo_db.id,
-                                                                             tipo=tipo.strip(),
-                                                                             nome=nome.strip()).first()
-                            if not parte_existente:
-                                session.add(Parte(processo_id=processo_db.id, tipo=tipo.strip(), nome=nome.strip()))
-                                print(f"    -> Parte '{nome.strip()}' salva.")
-                        except:
-                            print(f"    -> ERRO: Formato inválido na coluna 'partes': {p}")
-
-                # --- 4. ADVOGADOS ---
-                advs_texto = primeira_linha.get('advogados')
-                if pd.notna(advs_texto):
-                    advs_lista = str(advs_texto).split('|')
-                    for a in advs_lista:
-                        try:
-                            tipo, nome_oab = a.split(':', 1)
-                            nome, oab = extrair_oab(nome_oab)
-                            adv_existente = session.query(Advogado).filter_by(processo_id=processo_db.id,
-                                                                              tipo=tipo.strip(), nome=nome).first()
-                            if not adv_existente:
-                                session.add(Advogado(processo_id=processo_db.id, tipo=tipo.strip(), nome=nome, oab=oab))
-                                print(f"    -> Advogado '{nome}' salvo.")
-                        except:
-                            print(f"    -> ERRO: Formato inválido na coluna 'advogados': {a}")
-
-                # --- 5. ANDAMENTOS (itera em TODAS as linhas) ---
-                for _, row in proc_group.iterrows():
-                    if 'andamentoData' in row and pd.notna(row['andamentoData']):
-                        data_andamento = pd.to_datetime(row['andamentoData'])
-                        desc_andamento = row.get('andamentoDescricao')
-
-                        andamento_existente = session.query(Andamento).filter_by(processo_id=processo_db.id,
-                                                                                 data=data_andamento,
-                                                                                 descricao=desc_andamento).first()
-                        if not andamento_existente:
-                            session.add(
-                                Andamento(processo_id=processo_db.id, data=data_andamento, descricao=desc_andamento))
-                            print(f"    -> Andamento de '{data_andamento.date()}' salvo.")
-
-                # Atualiza status do processo e pesquisa
-                processo_db.dados_processo_encontrado = True
-
+                    session.add(novo_doc)
+                    print(f"    -> Link S3 salvo.")
+
+            # --- 3. PARTES ---
+            partes_texto = primeira_linha.get('partes')
+            if pd.notna(partes_texto):
+                partes_lista = str(partes_texto).split('|')
+                for p in partes_lista:
+                    try:
+                        tipo, nome = p.split(':', 1)
+                        tipo_id = obter_id_rotulo(session, tipo.strip())
+                        # Verifica se a parte já existe para evitar duplicatas
+                        parte_existente = session.query(Parte).filter_by(processo_id=processo_db.id,
+                                                                         tipo_id=tipo_id,
+                                                                         nome=nome.strip()).first()
+                        if not parte_existente:
+                            session.add(Parte(processo_id=processo_db.id, tipo_id=tipo_id, nome=nome.strip()))
+                            print(f"    -> Parte '{nome.strip()}' salva.")
+                    except:
+                        print(f"    -> ERRO: Formato inválido na coluna 'partes': {p}")
+
+            # --- 4. ADVOGADOS ---
+            advs_texto = primeira_linha.get('advogados')
+            if pd.notna(advs_texto):
+                advs_lista = str(advs_texto).split('|')
+                for a in advs_lista:
+                    try:
+                        tipo, nome_oab = a.split(':', 1)
+                        nome, oab = extrair_oab(nome_oab)
+                        tipo_id = obter_id_rotulo(session, tipo.strip())
+                        adv_existente = session.query(Advogado).filter_by(processo_id=processo_db.id,
+                                                                          tipo_id=tipo_id, nome=nome).first()
+                        if not adv_existente:
+                            session.add(Advogado(processo_id=processo_db.id, tipo_id=tipo_id, nome=nome, oab=oab))
+                            print(f"    -> Advogado '{nome}' salvo.")
+                    except:
+                        print(f"    -> ERRO: Formato inválido na coluna 'advogados': {a}")
+
+            # --- 5. ANDAMENTOS (itera em TODAS as linhas) ---
+            for _, row in proc_group.iterrows():
+                if 'andamentoData' in row and pd.notna(row['andamentoData']):
+                    data_andamento = pd.to_datetime(row['andamentoData'])
+                    descricao_id = obter_id_descricao(session, row.get('andamentoDescricao'))
+
+                    andamento_existente = session.query(Andamento).filter_by(processo_id=processo_db.id,
+                                                                             data=data_andamento,
+                                                                             descricao_id=descricao_id).first()
+                    if not andamento_existente:
+                        session.add(
+                            Andamento(processo_id=processo_db.id, data=data_andamento, descricao_id=descricao_id))
+                        print(f"    -> Andamento de '{data_andamento.date()}' salvo.")
+
+            # Atualiza status do processo (as pesquisas são atualizadas abaixo)
+            processo_db.dados_processo_encontrado = True
+            processos_importados.add(processo_db.id)
+
+        # Os números dos mesmos lotes que não vieram na planilha foram pesquisados e NÃO encontrados
+        # (continuam com dados_processo_encontrado=False). Todos os números desses lotes saem da espera.
+        processos_respondidos = set(processos_importados)
+        for bloco in dividir_em_blocos(sorted(lotes_respondidos)):
+            processos_respondidos.update(processo_id for (processo_id,) in session.query(Processo.id).filter(
+                Processo.lote_exportacao.in_(bloco)))
+        for bloco in dividir_em_blocos(sorted(processos_respondidos)):
+            session.query(Processo).filter(Processo.id.in_(bloco)).update({"lote_exportacao": None},
+                                                                          synchronize_session=False)
+
+        # Entrega o resultado às pesquisas em processamento ligadas aos processos respondidos, mas só quando
+        # nenhum processo da pesquisa ainda espera o robô (exportado em um lote cujo resultado não chegou).
+        aguardando_robo = exists().where(and_(
+            pesquisa_processo.c.pesquisa_id == Pesquisa.id,
+            pesquisa_processo.c.processo_id == Processo.id,
+            Processo.lote_exportacao.isnot(None)
+        ))
+        pesquisas_concluidas = []
+        for bloco in dividir_em_blocos(sorted(processos_respondidos)):
+            pesquisas_concluidas.extend(session.query(Pesquisa).filter(
+                Pesquisa.status == 'PROCESSANDO',
+                Pesquisa.id.in_(
+                    session.query(pesquisa_processo.c.pesquisa_id).filter(pesquisa_processo.c.processo_id.in_(bloco))
+                ),
+                ~aguardando_robo
+            ).all())
+        for pesquisa_db in {p.id: p for p in pesquisas_concluidas}.values():
             pesquisa_db.status = 'CONCLUIDO'
-            print(f"  Pesquisa {cod_pesquisa} marcada como CONCLUIDO.")
+            print(f"  Pesquisa {pesquisa_db.id} marcada como CONCLUIDO.")
+            if pesquisa_db.url_callback:
+                callbacks_pendentes.append((pesquisa_db.id, pesquisa_db.url_callback))
 
         session.commit()
         print("Importação concluída com sucesso!")
 
+        # Os webhooks só são disparados depois do commit (o cliente já encontra a pesquisa CONCLUIDO)
+        enviar_callbacks(callbacks_pendentes)
+        return len(df)
+
     except Exception as e:
         if session:
             session.rollback()
@@ -195,4 +369,8 @@ def importar_de_excel_v5():
 
 
 if __name__ == '__main__':
-    importar_de_excel_v5()
+    parser = argparse.ArgumentParser(description="Importa os resultados do robô (Excel) para o banco.")
+    parser.add_argument('--database-url', help="URL do banco (padrão: DATABASE_URL_REMOTE do config_local.py)")
+    parser.add_argument('--arquivo', default="resultados.xlsx", help="Planilha de resultados do robô")
+    args = parser.parse_args()
+    importar_de_excel_v5(database_url=args.database_url, arquivo=args.arquivo)
@@ -1,7 +1,8 @@
 import sys
 import datetime
+import argparse
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, exists
 import boto3
 from urllib.parse import urlparse
 
@@ -14,7 +15,7 @@ except ImportError:
 
 try:
     from app import Cliente, Pesquisa, Processo, CapaProcesso, DocumentoInicial, Andamento, Parte, Advogado, \
-        db as original_db
+        Rotulo, DescricaoAndamento, db as original_db, DIAS_PARA_LIMPEZA, travar_textos_repetidos
     from flask import Flask
 
     app = Flask(__name__)
@@ -25,36 +26,44 @@ except ImportError:
 # --- CONSTANTES ---
 S3_BUCKET_NAME = "andamentosconsult"  # Seu bucket S3
 S3_REGION = "us-east-2"  # Região do seu bucket (Ohio)
-DIAS_PARA_LIMPEZA = 7  # Apaga dados entregues há mais de 7 dias
+# DIAS_PARA_LIMPEZA vem do app.py (também usado nas estatísticas)
 
 
 # --- FUNÇÃO DE CONEXÃO ---
-def get_remote_session():
-    """ Cria uma sessão de banco de dados conectada ao PostgreSQL do Render. """
+def get_remote_session(database_url=None):
+    """ Cria uma sessão de banco de dados conectada ao PostgreSQL do Render (ou à URL informada). """
     print(f"Conectando ao banco de dados remoto...")
-    url = DATABASE_URL_REMOTE
+    url = database_url or DATABASE_URL_REMOTE
     engine = create_engine(url)
     with app.app_context():
         original_db.metadata.reflect(engine,
-                                     only=['cliente', 'pesquisa', 'processo', 'capaprocessp', 'documentoinicial',
-                                           'andamento', 'parte', 'advogado'])
+                                     only=['cliente', 'pesquisa', 'processo', 'pesquisa_processo', 'capaprocessp',
+                                           'documentoinicial', 'andamento', 'parte', 'advogado', 'rotulo',
+                                           'descricao_andamento'])
     Session = sessionmaker(bind=engine)
     return Session()
 
 
 # --- FUNÇÃO PRINCIPAL DE LIMPEZA ---
-def limpar_dados_antigos():
+def limpar_dados_antigos(database_url=None, s3_endpoint_url=None, s3_client=None):
+    """
+    database_url / s3_endpoint_url: substituem o banco do config_local.py e o endpoint da AWS
+    (ex.: banco e S3 locais). s3_client: cliente S3 já criado (usado pelo benchmark_pipeline.py).
+    Retorna o número de pesquisas apagadas, ou None se a limpeza falhou (erro no log).
+    """
     print("Iniciando script de limpeza de dados antigos...")
     session = None
 
     # 1. Conectar ao S3
     try:
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=S3_UPLOADER_ACCESS_KEY_ID,
-            aws_secret_access_key=S3_UPLOADER_SECRET_ACCESS_KEY,
-            region_name=S3_REGION
-        )
+        if s3_client is None:
+            s3_client = boto3.client(
+                's3',
+                aws_access_key_id=S3_UPLOADER_ACCESS_KEY_ID,
+                aws_secret_access_key=S3_UPLOADER_SECRET_ACCESS_KEY,
+                region_name=S3_REGION,
+                endpoint_url=s3_endpoint_url
+            )
         print("Conectado ao S3 com sucesso.")
     except Exception as e:
         print(f"ERRO: Falha ao conectar no S3. Verifique as chaves S3_UPLOADER no config_local.py. {e}")
@@ -62,7 +71,7 @@ def limpar_dados_antigos():
 
     # 2. Conectar ao Banco de Dados
     try:
-        session = get_remote_session()
+        session = get_remote_session(database_url)
 
         # 3. Define a data limite
         limite_data = datetime.datetime.utcnow() - datetime.timedelta(days=DIAS_PARA_LIMPEZA)
@@ -76,7 +85,7 @@ def limpar_dados_antigos():
 
         if not pesquisas_para_deletar:
             print("Nenhuma pesquisa antiga para limpar. Sistema está limpo.")
-            return
+            return 0
 
         print(f"Encontradas {len(pesquisas_para_deletar)} pesquisas para limpeza...")
 
@@ -84,7 +93,15 @@ def limpar_dados_antigos():
         for pesquisa in pesquisas_para_deletar:
             print(f"  Limpando Pesquisa ID: {pesquisa.id} (Entregue em: {pesquisa.data_entrega.date()})")
 
-            for processo in pesquisa.processos:
+            # Desfaz a ligação; o processo só é apagado se nenhuma outra pesquisa (de qualquer cliente) o usa
+            processos_da_pesquisa = list(pesquisa.processos)
+            pesquisa.processos = []
+            session.flush()
+
+            for processo in processos_da_pesquisa:
+                if processo.pesquisas:
+                    print(f"    -> Processo {processo.numero_processo} mantido (usado por outras pesquisas).")
+                    continue
 
                 # Deleta Documentos (e arquivos S3)
                 for doc in processo.documentos:
@@ -109,8 +126,26 @@ def limpar_dados_antigos():
             session.delete(pesquisa)
             print(f"  -> Pesquisa ID: {pesquisa.id} deletada do banco.")
 
+        # 6. Remove os textos (descrições/rótulos) que não são mais usados por nenhum registro.
+        # Com uma importação em andamento (que pode ter o id de um desses textos em cache), fica para a próxima.
+        session.flush()
+        if travar_textos_repetidos(session, exclusiva=True):
+            removidas = session.query(DescricaoAndamento).filter(
+                ~exists().where(Andamento.descricao_id == DescricaoAndamento.id)
+            ).delete(synchronize_session=False)
+            removidos = session.query(Rotulo).filter(
+                ~exists().where(Parte.tipo_id == Rotulo.id),
+                ~exists().where(Advogado.tipo_id == Rotulo.id),
+                ~exists().where(CapaProcesso.classe_cnj_id == Rotulo.id),
+                ~exists().where(CapaProcesso.area_id == Rotulo.id)
+            ).delete(synchronize_session=False)
+            print(f"  -> {removidas} descrições e {removidos} rótulos sem uso removidos.")
+        else:
+            print("  -> Importação em andamento: a remoção de textos sem uso fica para a próxima limpeza.")
+
         session.commit()
         print("Limpeza concluída com sucesso!")
+        return len(pesquisas_para_deletar)
 
     except Exception as e:
         if session:
@@ -122,4 +157,8 @@ def limpar_dados_antigos():
 
 
 if __name__ == '__main__':
-    limpar_dados_antigos()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Apaga pesquisas entregues há mais de DIAS_PARA_LIMPEZA dias.")
+    parser.add_argument('--database-url', help="URL do banco (padrão: DATABASE_URL_REMOTE do config_local.py)")
+    parser.add_argument('--s3-endpoint-url', help="Endpoint S3 alternativo (ex.: MinIO/moto local)")
+    args = parser.parse_args()
+    limpar_dados_antigos(database_url=args.database_url, s3_endpoint_url=args.s3_endpoint_url)
\ No newline at end of file
@@ -0,0 +1,302 @@
+"""
+Migra um banco existente (criado pelas versões anteriores do app.py) para o esquema atual SEM apagar dados.
+A rota /admin/setup-database recria o banco do zero e só serve para bancos novos.
+
+O que é feito (cada etapa verifica se já foi aplicada, então o script pode ser rodado mais de uma vez):
+  1. Cria as tabelas novas (pesquisa_processo, rotulo, descricao_andamento...).
+  2. Cadastro único de processos: junta os processos repetidos (mesmo numero_processo) em um registro,
+     move capa/documentos/andamentos/partes/advogados para ele, preenche pesquisa_processo e remove
+     processo.pesquisa_id.
+  3. Textos repetidos: copia andamento.descricao, parte/advogado.tipo e capaprocessp.classe_cnj/area para as
+     tabelas descricao_andamento e rotulo, troca as colunas de texto pelas colunas *_id e remove as antigas.
+  4. Adiciona as colunas novas simples (limites do cliente, url_callback, lote_exportacao) e os índices.
+  5. PostgreSQL: troca o índice de busca de texto pelo que ignora acentos (extensão unaccent).
+
+Uso (rode ANTES de publicar o novo app.py, com os scripts do robô parados):
+    python migrar_banco.py
+    python migrar_banco.py --database-url sqlite:///api.db
+
+Tudo roda em uma única transação: se algo falhar, nada é alterado (no SQLite, as alterações de esquema
+podem ficar pela metade; faça uma cópia do arquivo .db antes).
+"""
+import sys
+import argparse
+from sqlalchemy import create_engine, inspect, text
+
+# --- IMPORTAÇÃO DE CLASSES E CONFIGURAÇÕES ---
+try:
+    from app import Cliente, Pesquisa, Processo, CapaProcesso, Andamento, Parte, Advogado, DescricaoAndamento, \
+        db as original_db, CONFIGURACAO_BUSCA_TEXTO, DDL_BUSCA_TEXTO_POSTGRESQL
+    from importar_resultados import hash_texto
+    from flask import Flask
+
+    app = Flask(__name__)
+except ImportError:
+    print("ERRO CRÍTICO: Falha ao importar classes do app.py. O app.py está na pasta raiz?")
+    sys.exit(1)
+
+try:
+    from config_local import DATABASE_URL_REMOTE
+except ImportError:
+    print("ERRO CRÍTICO: O arquivo 'config_local.py' não foi encontrado. Crie e cole sua DATABASE_URL_REMOTE.")
+    sys.exit(1)
+
+
+TAMANHO_BLOCO_MIGRACAO = 1000  # Descrições de andamento lidas/gravadas por vez
+
+# Colunas adicionadas a tabelas que já existiam (todas aceitam NULL: o ADD COLUMN não precisa de valor)
+COLUNAS_NOVAS = [
+    Cliente.__table__.c.limite_requisicoes_minuto,
+    Cliente.__table__.c.limite_concorrencia,
+    Pesquisa.__table__.c.url_callback,
+    Processo.__table__.c.lote_exportacao,
+]
+
+# Colunas de texto trocadas por referência a uma tabela de textos únicos:
+# (modelo, coluna de texto antiga, coluna *_id nova, tabela de textos, coluna com o texto)
+TEXTOS_REPETIDOS = [
+    (Andamento, 'descricao', 'descricao_id', 'descricao_andamento', 'texto'),
+    (Parte, 'tipo', 'tipo_id', 'rotulo', 'valor'),
+    (Advogado, 'tipo', 'tipo_id', 'rotulo', 'valor'),
+    (CapaProcesso, 'classe_cnj', 'classe_cnj_id', 'rotulo', 'valor'),
+    (CapaProcesso, 'area', 'area_id', 'rotulo', 'valor'),
+]
+
+
+# --- FUNÇÕES HELPER ---
+
+def colunas_da_tabela(conexao, tabela):
+    return {coluna['name'] for coluna in inspect(conexao).get_columns(tabela)}
+
+
+def adicionar_coluna(conexao, coluna):
+    tipo = coluna.type.compile(dialect=conexao.dialect)
+    conexao.execute(text(f"ALTER TABLE {coluna.table.name} ADD COLUMN {coluna.name} {tipo}"))
+
+
+def recriar_tabela_sqlite(conexao, tabela, expressoes, juncoes=""):
+    """
+    O SQLite não remove colunas com chave estrangeira: renomeia a tabela antiga (alias 'a' no SELECT),
+    cria a nova pelo modelo e copia os dados. expressoes = {coluna_nova: expressão sobre a tabela antiga}.
+    """
+    nome = tabela.name
+    # legacy_alter_table: o RENAME não reescreve as chaves estrangeiras das outras tabelas (continuam em 'nome')
+    conexao.execute(text("PRAGMA legacy_alter_table=ON"))
+    conexao.execute(text(f"ALTER TABLE {nome} RENAME TO {nome}_antigo"))
+    # Os índices acompanham a tabela renomeada, com o mesmo nome dos que o modelo vai criar
+    for (indice,) in conexao.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :tabela AND sql IS NOT NULL"),
+            {"tabela": f"{nome}_antigo"}).fetchall():
+        conexao.execute(text(f"DROP INDEX {indice}"))
+    tabela.create(conexao)
+    conexao.execute(text(
+        f"INSERT INTO {nome} ({', '.join(expressoes)}) "
+        f"SELECT {', '.join(expressoes.values())} FROM {nome}_antigo a {juncoes}"
+    ))
+    conexao.execute(text(f"DROP TABLE {nome}_antigo"))
+
+
+def remover_repetidos(conexao, tabela, colunas):
+    """ Apaga as linhas iguais (mesmo processo e mesmos valores) criadas ao juntar processos; fica a de menor id. """
+    iguais = " AND ".join(f"(b.{c} = a.{c} OR (b.{c} IS NULL AND a.{c} IS NULL))" for c in colunas)
+    resultado = conexao.execute(text(
+        f"DELETE FROM {tabela} WHERE id IN ("
+        f"SELECT a.id FROM {tabela} a JOIN {tabela} b ON b.processo_id = a.processo_id AND b.id < a.id AND {iguais} "
+        f"WHERE a.processo_id IN (SELECT id_canonico FROM migracao_processo))"
+    ))
+    print(f"    -> {tabela}: {resultado.rowcount} linhas repetidas removidas.")
+
+
+# --- ETAPAS ---
+
+def migrar_processos_unicos(conexao):
+    """ Esquema antigo: um processo por pesquisa (processo.pesquisa_id). Novo: um por número + pesquisa_processo. """
+    if 'pesquisa_id' not in colunas_da_tabela(conexao, 'processo'):
+        print("Cadastro único de processos: já aplicado.")
+        return
+    print("Cadastro único de processos: juntando números repetidos...")
+
+    # Processo que fica (menor id de cada número) para cada processo repetido que vai ser apagado
+    conexao.execute(text(
+        "CREATE TEMPORARY TABLE migracao_processo AS "
+        "SELECT p.id AS id_antigo, c.id_canonico FROM processo p JOIN ("
+        "  SELECT numero_processo, MIN(id) AS id_canonico FROM processo GROUP BY numero_processo"
+        ") c ON c.numero_processo = p.numero_processo WHERE p.id <> c.id_canonico"
+    ))
+
+    # Ligações pesquisa -> processo (já apontando para o processo que fica)
+    resultado = conexao.execute(text(
+        "INSERT INTO pesquisa_processo (pesquisa_id, processo_id) "
+        "SELECT DISTINCT p.pesquisa_id, COALESCE(m.id_canonico, p.id) FROM processo p "
+        "LEFT JOIN migracao_processo m ON m.id_antigo = p.id "
+        "WHERE NOT EXISTS (SELECT 1 FROM pesquisa_processo pp "
+        "  WHERE pp.pesquisa_id = p.pesquisa_id AND pp.processo_id = COALESCE(m.id_canonico, p.id))"
+    ))
+    print(f"    -> {resultado.rowcount} ligações em pesquisa_processo.")
+
+    conexao.execute(text(
+        "UPDATE processo SET dados_processo_encontrado = TRUE WHERE id IN ("
+        "  SELECT m.id_canonico FROM migracao_processo m JOIN processo p ON p.id = m.id_antigo "
+        "  WHERE p.dados_processo_encontrado = TRUE)"
+    ))
+
+    # Capa (uma por processo): fica a do processo que fica ou, se ele não tiver, a primeira dos repetidos
+    conexao.execute(text(
+        "DELETE FROM capaprocessp WHERE id IN ("
+        "  SELECT c.id FROM capaprocessp c JOIN migracao_processo m ON m.id_antigo = c.processo_id"
+        "  WHERE EXISTS (SELECT 1 FROM capaprocessp c2 WHERE c2.processo_id = m.id_canonico)"
+        "     OR EXISTS (SELECT 1 FROM capaprocessp c3 JOIN migracao_processo m3 ON m3.id_antigo = c3.processo_id"
+        "                WHERE m3.id_canonico = m.id_canonico AND c3.id < c.id))"
+    ))
+    for tabela in ['capaprocessp', 'documentoinicial', 'andamento', 'parte', 'advogado']:
+        conexao.execute(text(
+            f"UPDATE {tabela} SET processo_id = ("
+            f"  SELECT m.id_canonico FROM migracao_processo m WHERE m.id_antigo = {tabela}.processo_id) "
+            f"WHERE processo_id IN (SELECT id_antigo FROM migracao_processo)"
+        ))
+    remover_repetidos(conexao, 'documentoinicial', ['link_documento'])
+    remover_repetidos(conexao, 'andamento', ['data', 'descricao'])
+    remover_repetidos(conexao, 'parte', ['tipo', 'nome'])
+    remover_repetidos(conexao, 'advogado', ['tipo', 'nome'])
+
+    resultado = conexao.execute(text("DELETE FROM processo WHERE id IN (SELECT id_antigo FROM migracao_processo)"))
+    print(f"    -> {resultado.rowcount} processos repetidos removidos.")
+    conexao.execute(text("DROP TABLE migracao_processo"))
+
+    # Remove processo.pesquisa_id e cria a restrição de número único
+    if conexao.dialect.name == 'sqlite':
+        recriar_tabela_sqlite(conexao, Processo.__table__, {
+            'id': 'a.id', 'numero_processo': 'a.numero_processo',
+            'dados_processo_encontrado': 'a.dados_processo_encontrado',
+        })
+    else:
+        conexao.execute(text("ALTER TABLE processo DROP COLUMN pesquisa_id"))
+        conexao.execute(text(
+            "ALTER TABLE processo ADD CONSTRAINT processo_numero_processo_key UNIQUE (numero_processo)"))
+    print("Cadastro único de processos: concluído.")
+
+
+def migrar_textos_repetidos(conexao):
+    """ Esquema antigo: textos repetidos em cada linha. Novo: guardados uma vez (rotulo/descricao_andamento). """
+    pendentes = [item for item in TEXTOS_REPETIDOS
+                 if item[1] in colunas_da_tabela(conexao, item[0].__tablename__)]
+    if not pendentes:
+        print("Textos repetidos: já aplicado.")
+        return
+    print("Textos repetidos: copiando para as tabelas rotulo e descricao_andamento...")
+
+    # 1. Rótulos: um INSERT com todos os valores distintos das colunas antigas
+    fontes = [f"SELECT {antiga} AS valor FROM {modelo.__tablename__}"
+              for modelo, antiga, _, referencia, _ in pendentes if referencia == 'rotulo']
+    if fontes:
+        resultado = conexao.execute(text(
+            f"INSERT INTO rotulo (valor) SELECT v.valor FROM ({' UNION '.join(fontes)}) v "
+            f"WHERE v.valor IS NOT NULL AND NOT EXISTS (SELECT 1 FROM rotulo r WHERE r.valor = v.valor)"
+        ))
+        print(f"    -> {resultado.rowcount} rótulos criados.")
+
+    # 2. Descrições: o hash (SHA-1) é calculado aqui, igual ao do importar_resultados.py
+    if any(modelo is Andamento for modelo, *_ in pendentes):
+        hashes_existentes = {h for (h,) in conexao.execute(text("SELECT hash_texto FROM descricao_andamento"))}
+        distintos = conexao.execution_options(stream_results=True).execute(
+            text("SELECT DISTINCT descricao FROM andamento WHERE descricao IS NOT NULL"))
+        criadas = 0
+        for bloco in distintos.partitions(TAMANHO_BLOCO_MIGRACAO):
+            novas = []
+            for (texto,) in bloco:
+                hash_descricao = hash_texto(texto)
+                if hash_descricao not in hashes_existentes:
+                    hashes_existentes.add(hash_descricao)
+                    novas.append({"hash_texto": hash_descricao, "texto": texto})
+            if novas:
+                conexao.execute(DescricaoAndamento.__table__.insert(), novas)
+                criadas += len(novas)
+        print(f"    -> {criadas} descrições de andamento criadas.")
+
+    # 3. Troca as colunas de texto pelas colunas *_id
+    for modelo in dict.fromkeys(modelo for modelo, *_ in pendentes):
+        trocas = [item[1:] for item in pendentes if item[0] is modelo]
+        tabela = modelo.__table__
+        if conexao.dialect.name == 'sqlite':
+            novas = {nova for _, nova, _, _ in trocas}
+            expressoes = {coluna.name: f"a.{coluna.name}" for coluna in tabela.columns if coluna.name not in novas}
+            juncoes = ""
+            for i, (antiga, nova, referencia, coluna_texto) in enumerate(trocas):
+                expressoes[nova] = f"r{i}.id"
+                juncoes += f" LEFT JOIN {referencia} r{i} ON r{i}.{coluna_texto} = a.{antiga}"
+            recriar_tabela_sqlite(conexao, tabela, expressoes, juncoes)
+        else:
+            for antiga, nova, referencia, coluna_texto in trocas:
+                conexao.execute(text(
+                    f"ALTER TABLE {tabela.name} ADD COLUMN {nova} INTEGER REFERENCES {referencia} (id)"))
+                conexao.execute(text(
+                    f"UPDATE {tabela.name} SET {nova} = r.id FROM {referencia} r "
+                    f"WHERE r.{coluna_texto} = {tabela.name}.{antiga}"
+                ))
+                conexao.execute(text(f"ALTER TABLE {tabela.name} DROP COLUMN {antiga}"))
+        print(f"    -> {tabela.name}: {', '.join(antiga for antiga, *_ in trocas)} -> "
+              f"{', '.join(nova for _, nova, *_ in trocas)}.")
+    print("Textos repetidos: concluído.")
+
+
+def migrar_colunas_novas(conexao):
+    for coluna in COLUNAS_NOVAS:
+        if coluna.name not in colunas_da_tabela(conexao, coluna.table.name):
+            adicionar_coluna(conexao, coluna)
+            print(f"Coluna {coluna.table.name}.{coluna.name} adicionada.")
+
+
+def criar_indices(conexao):
+    # Índices dos modelos em tabelas que já existiam (o create_all só cria os índices das tabelas novas)
+    for tabela in original_db.metadata.sorted_tables:
+        colunas = colunas_da_tabela(conexao, tabela.name)
+        for indice in tabela.indexes:
+            if all(coluna.name in colunas for coluna in indice.columns):
+                indice.create(conexao, checkfirst=True)
+
+
+def migrar_busca_sem_acento(conexao):
+    if conexao.dialect.name != 'postgresql':
+        return  # SQLite: o FTS5 já é criado com remove_diacritics
+    definicao = conexao.execute(text(
+        "SELECT indexdef FROM pg_indexes WHERE indexname = 'ix_descricao_andamento_fts'")).scalar()
+    if definicao and CONFIGURACAO_BUSCA_TEXTO in definicao:
+        print("Busca de texto sem acentos: já aplicado.")
+        return
+    if definicao:
+        conexao.execute(text("DROP INDEX ix_descricao_andamento_fts"))
+    for ddl in DDL_BUSCA_TEXTO_POSTGRESQL:
+        conexao.execute(ddl)
+    print("Busca de texto sem acentos: índice recriado.")
+
+
+def migrar_banco(database_url=None):
+    url = database_url or DATABASE_URL_REMOTE
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    engine = create_engine(url)
+
+    print("Iniciando migração do banco...")
+    try:
+        with engine.begin() as conexao:
+            with app.app_context():
+                original_db.metadata.create_all(conexao, checkfirst=True)
+            migrar_processos_unicos(conexao)
+            migrar_textos_repetidos(conexao)
+            migrar_colunas_novas(conexao)
+            criar_indices(conexao)
+            migrar_busca_sem_acento(conexao)
+        print("Migração concluída com sucesso!")
+        return True
+    except Exception as e:
+        print(f"ERRO CRÍTICO durante a migração (nenhuma alteração foi gravada): {e}")
+        return False
+    finally:
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migra o banco existente para o esquema atual sem apagar dados.")
+    parser.add_argument('--database-url', help="URL do banco (padrão: DATABASE_URL_REMOTE do config_local.py)")
+    args = parser.parse_args()
+    sys.exit(0 if migrar_banco(database_url=args.database_url) else 1)